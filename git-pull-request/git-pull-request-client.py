@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Thin client for the gitpr server, used by git-pull-request.sh while the server
+is running (see 'gitpr server start').
+
+Sends the command line, directory and environment to the server, and writes
+the output it sends back to the standard output and error. If the server
+cannot be reached, is busy with another command for more than READY_TIMEOUT
+seconds, or the command may need the terminal, the command is run by
+git-pull-request.py instead.
+"""
+
+import fcntl
+import json
+import os
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+
+# Seconds to wait for the server to finish the command it is running
+READY_TIMEOUT = 2
+
+def get_terminal_rows():
+	try:
+		return struct.unpack('hh', fcntl.ioctl(1, termios.TIOCGWINSZ, '1234'))[0]
+	except IOError:
+		return 0
+
+def page(output):
+	"""Shows output through the pager, as git-pull-request.py does for long
+	listings"""
+
+	pager = os.popen('git var GIT_PAGER').read().strip() or 'less'
+
+	env = dict(os.environ)
+	env.setdefault('LESS', 'FRX')
+
+	process = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE, env=env)
+	process.communicate(output)
+
+def read(connection, size):
+	data = ''
+
+	while len(data) < size:
+		chunk = connection.recv(size - len(data))
+
+		if chunk == '':
+			return None
+
+		data += chunk
+
+	return data
+
+def run_locally():
+	script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'git-pull-request.py')
+	os.execv(script_path, [script_path] + sys.argv[1:])
+
+def is_private_dir(path):
+	"""Returns whether the path is a directory only the current user can access,
+	so that nobody else can have created the socket in it"""
+
+	try:
+		info = os.lstat(path)
+	except OSError:
+		return False
+
+	return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and info.st_mode & 077 == 0
+
+def main():
+	args = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+
+	# The server is started and stopped from a separate process
+	if args[:1] == ['server']:
+		run_locally()
+
+	socket_dir = os.path.join(tempfile.gettempdir(), 'git-pull-request-%s' % os.getuid())
+	socket_path = os.path.join(socket_dir, 'server.sock')
+
+	# The request carries the environment, with its tokens and agent sockets
+	if not is_private_dir(socket_dir):
+		run_locally()
+
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	connection.settimeout(READY_TIMEOUT)
+
+	# The server sends an empty 'r' frame when it is ready for the request
+	try:
+		connection.connect(socket_path)
+		header = read(connection, 5)
+	except socket.error:
+		header = None
+
+	if header is None or header[0] != 'r':
+		connection.close()
+		run_locally()
+
+	connection.settimeout(None)
+
+	isatty = sys.stdout.isatty()
+	rows = 0
+
+	if isatty:
+		rows = get_terminal_rows()
+
+	request = {
+		'args': sys.argv[1:],
+		'cwd': os.getcwd(),
+		'env': dict(os.environ),
+		'isatty': isatty,
+		'rows': rows
+	}
+
+	connection.sendall('%s\n' % json.dumps(request))
+
+	streams = {'1': sys.stdout, '2': sys.stderr}
+
+	while True:
+		header = read(connection, 5)
+
+		if header is None:
+			sys.stderr.write("The gitpr server closed the connection\n")
+			return 1
+
+		channel, size = struct.unpack('>cI', header)
+		data = read(connection, size)
+
+		if data is None:
+			sys.stderr.write("The gitpr server closed the connection\n")
+			return 1
+
+		if channel == 'x':
+			return int(data)
+		elif channel == 'l':
+			connection.close()
+			run_locally()
+		elif channel == 'p':
+			sys.stdout.flush()
+			page(data)
+		else:
+			streams[channel].write(data)
+			streams[channel].flush()
+
+if __name__ == "__main__":
+	try:
+		sys.exit(main())
+	except KeyboardInterrupt:
+		sys.exit(130)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+"""
+Shell completion for gitpr, run by git-pull-request-completion.bash and
+git-pull-request-completion.zsh on every TAB.
+
+Python compiles the script it runs every time, which takes longer than the
+completion itself for a file the size of git-pull-request.py. Loading it as a
+module instead reuses the bytecode cached next to it by the first completion.
+"""
+
+import imp
+import os
+import sys
+
+def main():
+	script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'git-pull-request.py')
+
+	git_pull_request = imp.load_source('git_pull_request', script_path)
+	git_pull_request.command_complete(sys.argv[1:])
+
+if __name__ == "__main__":
+	main()
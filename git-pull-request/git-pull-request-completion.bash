@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# Bash completion for gitpr. Add the following line to your bash profile, after
+# the gitpr alias:
+# source YOUR_DIRECTORY/git-pull-request/git-pull-request-completion.bash
+
+_GITPR_DIR=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+
+_gitpr() {
+	local IFS=$'\n'
+
+	COMPREPLY=($("$_GITPR_DIR/git-pull-request-complete.py" "${COMP_WORDS[@]:1:$COMP_CWORD}" 2>/dev/null))
+}
+
+complete -F _gitpr gitpr
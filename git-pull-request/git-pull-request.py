@@ -25,6 +25,29 @@ Options:
 	-b <branch>, --update-branch <branch>
 		Specify the target branch on the reviewer github repository to submit the pull request.
 
+	--format <format>
+		Output the pull requests, repositories, stats, fetches and report rows
+		of the #no command#, info, info-detailed, stats, fetch-all and report
+		commands as machine-readable records, one per line as soon as each is
+		available.
+		Possible formats: 'text' (the default), 'jsonl' (JSON Lines) and 'tsv'
+		(tab separated values, with a '#' header line for each record type).
+		Any other output is written to stderr.
+
+	--repos <paths>
+		Run the command over several local repositories in one process. Takes a
+		comma separated list of paths, which can contain wildcards (for example
+		'~/liferay-portal*'). Supported for the #no command#, stats and fetch-all
+		commands. The github responses are shared between the repositories, the
+		git work is done in parallel and a summary is displayed at the end.
+
+	--filter <filter-spec>
+		Fetch pull requests as a partial clone using this filter (for example
+		'blob:none' or 'tree:0'), so file contents are only downloaded when they
+		are needed. The pull requests are fetched from the remote the partial
+		clone was made from, when the pull requests are sent to it. Overrides the
+		'fetch-filter' git config setting.
+
 Commands:
 
 	#no command#
@@ -37,19 +60,57 @@ Commands:
 		Create an alias for the github name so you can use it in your git-pr submit
 		command.
 
+	check [<pull request ID>]
+		Reports whether the specified pull request, or all open pull requests,
+		merge cleanly into the update-branch, and which files conflict. Uses an
+		in-memory merge (git merge-tree, git 2.38 or newer), so the index and
+		work tree are never touched.
+
 	close [<comment>]
 		Closes the current pull request on github and deletes the pull request
 		branch.
 
+	close [--dry-run] <pull request ID>... [<comment>]
+	close [--dry-run] [--stale-days <days>] [--label <label>] [<comment>]
+		Closes several open pull requests at once, selected by ID, by the number
+		of days since they were last updated, and/or by label. The pull
+		requests are closed in parallel and a summary is displayed at the end.
+		Their local branches are kept, use 'gitpr gc' to delete them. With
+		--dry-run the matching pull requests are only listed.
+
+	commit-graph
+		Displays the layers of the commit-graph, whether they have changed-path
+		Bloom filters and how many commits are missing from it, and writes a new
+		layer if it is stale.
+
+	complete [<args>] <word>
+		Prints the completions for the last word of a gitpr command line. Used
+		by the bash and zsh completion scripts, answers from the locally cached
+		pull request list and refreshes it in the background when it is old.
+
 	continue-update, cu
 		Continues the current update after conflicts have been fixed.
 
+	diff [<pull request ID>]
+		Displays the commits, diff stat and diff (detecting renames and copies)
+		of the fetched pull request, or of the current pull request branch,
+		against the update-branch. Fetching renders them in the background, so
+		they are shown right away unless the branch has moved since.
+
 	fetch <pull request ID>
 		Fetches the pull request into a local branch, optionally updating it
 		and checking it out.
 
-	fetch-all
-		Fetches all open pull requests into local branches.
+	fetch-all [--restart]
+		Fetches all open pull requests into local branches. Pull requests that
+		fail to fetch are reported at the end instead of stopping the command,
+		and running it again only fetches the pull requests that failed or were
+		not reached, unless --restart is given.
+
+	gc [--origin] [--dry-run]
+		Deletes the local branches of pull requests that are no longer open, all
+		in one ref transaction. With --origin the matching branches are also
+		deleted from origin in a single push.
 
 	help
 		Displays this message.
@@ -65,26 +126,73 @@ Commands:
 		Merges the current pull request branch into the update-branch and deletes the
 		branch.
 
+	merge-order
+		Suggests an order to merge the fetched open pull requests in, starting
+		with the ones that change the fewest files shared with other pull
+		requests.
+
 	open [<pull request ID>]
 		Opens either the current pull request or the specified request on
 		github.
 
+	overlap [<pull request ID>]
+		Lists the fetched open pull requests that change the same files as the
+		specified pull request, or as each other. Uses an index of the files
+		changed by each pull request, kept up to date by this command, merge-order
+		and stats.
+
 	pull
 		Pulls remote changes from the other user's remote branch into the local
 		pull request branch.
 
+	report [--remote]
+		Displays the open pull requests aggregated by author, base branch, file
+		extension and age, with the number of files and lines they change.
+		Authors are shown by github login along with their user aliases, and a
+		login set as an alias of another one is counted under it. The pull
+		requests are walked once, reusing the cached diff stats; with --remote
+		the stats of pull requests that have not been fetched are loaded from
+		github instead of fetching them.
+
+	server [start|stop|status]
+		Starts a gitpr server for the current user in the background, which
+		keeps the parsed git config, the user aliases and the github responses
+		(for 'response-cache-ttl' seconds) in memory between commands. While it
+		runs, git-pull-request.sh sends the commands to it through a Unix socket
+		instead of starting a new python process for each one. The server runs
+		one command at a time; when it is busy for more than a couple of
+		seconds the command is run without it. Commands that may need the
+		terminal, to edit a commit message or to ask for credentials
+		(continue-update, merge, pull, submit and gc --origin), are always
+		run without it.
+
 	show-alias <alias>
 		Shows the github username pointed by the indicated alias.
 
-	stats
+	stats [--restart]
 		Fetches all open pull requests on this repository and displays them along
 		with statistics about the pull requests and how many changes (along with how many
-		changes by type).
+		changes by type). The stats are cached by merge-base and head commit, so only
+		pull requests that changed since the last run are diffed again. Failures
+		and reruns are handled as in fetch-all.
+
+	stats --remote [<pull request ID>]
+		Displays the same statistics computed from the files listed by the github
+		API, without fetching the pull requests. Pull requests with more files
+		than the API lists, or whose files cannot be listed, are fetched and
+		diffed locally instead.
 
 	submit [<pull body>] [<pull title>]
 		Pushes a branch and sends a pull request to the user's reviewer on
 		github.
 
+	submit --branches <branch>...
+	submit --pattern <pattern> [<pull body>]
+		Pushes several branches, or all the local branches matching the
+		wildcard pattern, in a single push and sends a pull request for each of
+		them in parallel. Branches already up to date on origin are not pushed
+		again. The URLs of the pull requests are displayed at the end.
+
 	update [<pull request ID or branch name>]
 		Updates the current pull request or the specified request with the local
 		changes in the update-branch, using either a rebase or merge.
@@ -106,16 +214,24 @@ Miguel Pastor<miguel.pastor@liferay.com>
 Released under the MIT License.
 """
 
-import base64
+import fcntl
+import fnmatch
 import getopt
+import glob
 import json
 import os
 import re
+import stat
+import struct
+import subprocess
 import sys
-import urllib
-import urllib2
+import tempfile
+import termios
+import time
 # import isodate
-# from datetime import date
+
+# base64, multiprocessing, select, socket, threading, traceback, urllib and
+# urllib2 are imported by import_modules, after the shell completion returns
 
 # Connecting through a proxy,
 # requires: socks.py from http://socksipy.sourceforge.net/ next to this file
@@ -126,6 +242,8 @@ import urllib2
 #socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, "localhost", 8181)
 #socket.socket = socks.socksocket
 
+from collections import OrderedDict
+from datetime import date
 from textwrap import fill
 
 options = {
@@ -146,24 +264,70 @@ options = {
 	# Disable the color scheme
 	'enable-color': True,
 
+	# Sets how much of the body of each pull request is displayed in listings.
+	# Possible options: 'full', 'truncate' (only the start of the first line),
+	# 'none'
+	'display-body': 'full',
+
+	# Sets the format of the records output by the listing commands.
+	# Possible options: 'text', 'jsonl', 'tsv'
+	'format': 'text',
+
 	# Sets the default comment to post when closing a pull request.
 	'close-default-comment': None,
 
+	# Sets the number of seconds after which the pull request list cached for
+	# shell completion is refreshed in the background.
+	'complete-cache-ttl': 300,
+
 	# Determines whether fetch will automatically checkout the new branch.
 	'fetch-auto-checkout': False,
 
+	# Determines whether fetch and fetch-all render the review diffs of the
+	# fetched pull requests in the background, so that the diff command shows
+	# them right away.
+	'fetch-render-diffs': True,
+
 	# Determines whether to automatically update a fetched pull request branch.
 	# Setting this option to true will also cause the new branch to be checked
 	# out.
 	'fetch-auto-update': False,
 
+	# Sets the partial clone filter to use when fetching pull requests, so that
+	# blobs (or trees) are downloaded lazily on checkout instead of up front.
+	# Requires the repository to be a partial clone (git clone --filter) of the
+	# repository the pull requests are sent to, they are then fetched from it.
+	# Possible options: None, 'blob:none', 'tree:0'
+	'fetch-filter': None,
+
 	# Whether to show pull requests for the entire repo or just the update-branch.
 	'filter-by-update-branch': True,
 
+	# Determines whether to keep the commit-graph, along with its changed-path
+	# Bloom filters, up to date after pull requests are fetched. This speeds up
+	# merge-base computations and path-limited git log.
+	'commit-graph': True,
+
 	# Determines whether to automatically close pull requests after merging
 	# them.
 	'merge-auto-close': True,
 
+	# Determines whether listings longer than the terminal are shown through a
+	# pager (git's core.pager, $GIT_PAGER or $PAGER, less by default).
+	'pager': True,
+
+	# Sets the number of pull requests to process in parallel by the commands
+	# that support it.
+	'parallel-jobs': 8,
+
+	# Sets the number of seconds the responses from github are reused for,
+	# across the commands run by the gitpr server.
+	'response-cache-ttl': 60,
+
+	# Sets the maximum number of entries kept in the diff stats cache. The least
+	# recently used entries are evicted first.
+	'stats-cache-size': 1000,
+
 	# Sets the branch to use where updates are merged from or to.
 	'update-branch': 'master',
 
@@ -178,16 +342,190 @@ options = {
 	# Sets a directory to be used for performing updates to prevent
 	# excessive rebuilding by IDE's. Warning: This directory will be hard reset
 	# every time an update is performed, so do not do any work other than
-	# conflict merges in the work directory.
+	# conflict merges in the work directory. It can be created from an existing
+	# checkout with: git-new-workdir --seed <checkout> <repository> <work-dir>
 	'work-dir': None
 }
 
+_cat_file = None
+_color_codes = {}
+_fetched = False
+_file_index = None
+_file_index_changes = {}
+_git_config = None
+_git_dir = None
+_git_configs = {}
+_rate_limit_remaining = None
+_rate_limit_shared = None
+_record_list = None
+_record_stream = None
+_record_types = set()
+_remote_stats_unavailable = set()
+_output_buffer = None
+_output_stream = None
+_refs = None
+_responses = {}
+_server_relay = None
+_state_dir = None
+_stats_cache = None
+_terminal = None
+_users = None
+_users_alias_file = None
+_users_by_login = None
+_users_signature = None
+
+class OutputBuffer(object):
+	"""File-like object collecting the output for end_output, with unicode text
+	encoded as UTF-8"""
+
+	def __init__(self):
+		self.chunks = []
+
+	def flush(self):
+		pass
+
+	def getvalue(self):
+		return ''.join(self.chunks)
+
+	def isatty(self):
+		return False
+
+	def write(self, text):
+		if isinstance(text, unicode):
+			text = text.encode('utf-8')
+
+		self.chunks.append(text)
+
+class ServerRelay(object):
+	"""Sends the output of a command run by the gitpr server to its client. The
+	standard output and error are redirected to pipes, so that the git commands
+	run by gitpr write to them as well, and their contents are sent in frames
+	tagged with the stream they were written to."""
+
+	def __init__(self, connection):
+		self.aborted = False
+		self.connection = connection
+		self.local = False
+		self.lock = threading.Lock()
+		self.done = threading.Event()
+		self.pipes = {}
+		self.saved_fds = {}
+
+		sys.stdout.flush()
+		sys.stderr.flush()
+
+		for fd in (1, 2):
+			read_fd, write_fd = os.pipe()
+
+			self.pipes[read_fd] = str(fd)
+			self.saved_fds[fd] = os.dup(fd)
+
+			os.dup2(write_fd, fd)
+			os.close(write_fd)
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def close(self, exit_code):
+		"""Restores the standard output and error, and sends what is left in the
+		pipes along with the exit code of the command"""
+
+		sys.stdout.flush()
+		sys.stderr.flush()
+
+		for fd, saved_fd in self.saved_fds.items():
+			os.dup2(saved_fd, fd)
+			os.close(saved_fd)
+
+		self.done.set()
+		self.thread.join()
+
+		self.lock.acquire()
+
+		try:
+			self.drain()
+
+			# The client runs the command itself instead
+			if self.local:
+				self.send('l', '')
+			else:
+				self.send('x', str(exit_code))
+		finally:
+			self.lock.release()
+
+		for read_fd in self.pipes:
+			os.close(read_fd)
+
+	def drain(self):
+		"""Sends everything written to the pipes so far, the lock must be held"""
+
+		for read_fd, channel in self.pipes.items():
+			while True:
+				available = struct.unpack('i', fcntl.ioctl(read_fd, termios.FIONREAD, '\0' * 4))[0]
+
+				if available == 0:
+					break
+
+				self.send(channel, os.read(read_fd, available))
+
+	def page(self, output):
+		"""Sends output for the client to show through its pager, after the
+		output written before it"""
+
+		sys.stdout.flush()
+		sys.stderr.flush()
+
+		self.lock.acquire()
+
+		try:
+			self.drain()
+			self.send('p', output)
+		finally:
+			self.lock.release()
+
+	def run(self):
+		while not self.done.is_set():
+			watched = self.pipes.keys()
+
+			# The client sends nothing after its request, so the connection only
+			# becomes readable when it goes away (for example on Ctrl-C)
+			if not self.aborted:
+				watched.append(self.connection)
+
+			readable = select.select(watched, [], [], 0.1)[0]
+
+			if self.connection in readable:
+				self.aborted = True
+
+			if readable:
+				self.lock.acquire()
+
+				try:
+					self.drain()
+				finally:
+					self.lock.release()
+
+	def send(self, channel, data):
+		if self.aborted:
+			return
+
+		try:
+			self.connection.sendall(struct.pack('>cI', channel, len(data)) + data)
+		except socket.error:
+			# The client went away, check_interrupted stops the command
+			self.aborted = True
+
 #print json.dumps(data,sort_keys=True, indent=4)
 
 def authorize_request(req):
 	"""Add the Authorize header to the request"""
 
-	req.add_header("Authorization", "Basic %s" % auth_string)
+	# Version 3 of the API takes the token itself
+	if req.get_host() == 'api.github.com':
+		req.add_header("Authorization", "token %s" % auth_token)
+	else:
+		req.add_header("Authorization", "Basic %s" % auth_string)
 
 def build_branch_name(pull_request):
 	"""Returns the local branch name that a pull request should be fetched into"""
@@ -216,25 +554,37 @@ def build_pull_request_title(branch_name):
 	return branch_name
 
 def chdir(dir):
-	f = open('/tmp/git-pull-request-chdir', 'wb')
+	"""Tells git-pull-request.sh to change into the directory once the command
+	is done, through the file it created for this invocation"""
+
+	chdir_path = os.environ.get('GIT_PULL_REQUEST_CHDIR')
+
+	if not chdir_path:
+		return
+
+	f = open(chdir_path, 'wb')
 	f.write(dir)
 	f.close()
 
+def check_interrupted():
+	"""Stops a command run by the gitpr server whose client went away, as Ctrl-C
+	would have stopped it when run directly. Called between the pull requests of
+	the commands changing many of them."""
+
+	if _server_relay is not None and _server_relay.aborted:
+		raise UserWarning("The command was interrupted")
+
 def close_pull_request(repo_name, pull_request_ID, comment = None):
 	if comment is None:
 		comment = options['close-default-comment']
 
-	try:
-		f = open('/tmp/git-pull-request-treeish-%s' % pull_request_ID, 'rb')
-		branch_treeish = f.read()
-		f.close()
+	branch_treeish = load_state('treeish', {}).get(str(pull_request_ID))
 
+	if branch_treeish is not None:
 		if comment is None:
 			comment = ''
 
 		comment += "\n\nOriginal commits: %s" % branch_treeish
-	except IOError:
-		pass
 
 	if comment is not None and comment != '':
 		post_comment(repo_name, pull_request_ID, comment)
@@ -247,11 +597,13 @@ def color_text(text, token, bold = False):
 
 	# http://travelingfrontiers.wordpress.com/2010/08/22/how-to-add-colors-to-linux-command-line-output/
 
-	if options['enable-color'] == True:
-		color_name = options["color-%s" % token]
+	if options['enable-color'] != True or not detect_terminal()['isatty']:
+		return text
 
-		if color_name == 'default' or not sys.stdout.isatty():
-			return text
+	key = (token, bold)
+
+	if key not in _color_codes:
+		color_name = options["color-%s" % token]
 
 		colors = (
 			'black', 'red', 'green', 'yellow',
@@ -259,25 +611,42 @@ def color_text(text, token, bold = False):
 		)
 
 		if color_name in colors:
-			return u"\033[{0};{1}m{2}\033[0m".format(
-				int(bold),
-				colors.index(color_name) + 30,
-				text)
+			_color_codes[key] = u"\033[{0};{1}m".format(int(bold), colors.index(color_name) + 30)
 		else:
-			return text
-	else:
+			_color_codes[key] = None
+
+	if _color_codes[key] is None:
 		return text
 
-def command_alias(alias, githubname, filename):
+	return u"{0}{1}\033[0m".format(_color_codes[key], text)
+
+def command_alias(alias, githubname):
+	"""Creates or updates the alias. The change is appended to the journal of
+	the aliases file, which is only rewritten once the journal grows large."""
+
+	global _users
+
+	users_alias_file = get_users_alias_file()
+	lock_file = lock_path(users_alias_file)
+
 	try:
-		users[alias] = githubname
-	except Exception:
+		journal_file = open('%s.journal' % users_alias_file, 'ab')
+		journal_file.write('%s\n' % json.dumps([alias, githubname]))
+		journal_file.close()
+	except IOError:
+		lock_file.close()
 		raise UserWarning('Error while updating the alias for %s' % alias)
 
-	github_users_file = open(filename, 'w')
-	json.dump(users, github_users_file)
+	try:
+		# Reload to pick up the aliases added by other commands meanwhile
+		_users = None
+		get_users(True)
 
-	github_users_file.close()
+		if os.path.getsize('%s.journal' % users_alias_file) > 64 * 1024:
+			write_json_file(users_alias_file, _users)
+			os.remove('%s.journal' % users_alias_file)
+	finally:
+		lock_file.close()
 
 def command_fetch(repo_name, pull_request_ID, auto_update = False):
 	"""Fetches a pull request into a local branch"""
@@ -289,6 +658,8 @@ def command_fetch(repo_name, pull_request_ID, auto_update = False):
 	display_pull_request(pull_request)
 	branch_name = fetch_pull_request(pull_request)
 
+	render_diffs_in_background([branch_name])
+
 	if auto_update:
 		update_branch(branch_name)
 	elif options['fetch-auto-checkout']:
@@ -301,6 +672,58 @@ def command_fetch(repo_name, pull_request_ID, auto_update = False):
 	print
 	display_status()
 
+def command_check(repo_name, pull_request_ID = None):
+	"""Checks which pull requests merge cleanly into the update-branch without
+	touching the index or the work tree"""
+
+	update_branch_option = options['update-branch']
+
+	print color_text("Checking pull requests for conflicts with %s" % update_branch_option, 'status')
+	print
+
+	if pull_request_ID is None:
+		pull_requests = get_pull_requests(repo_name, options['filter-by-update-branch'])
+	else:
+		pull_requests = [get_pull_request(repo_name, pull_request_ID)]
+
+	base = rev_parse(update_branch_option)
+
+	if base is None:
+		raise UserWarning("Could not resolve %s" % update_branch_option)
+
+	heads = []
+
+	for pull_request in pull_requests:
+		branch_name = build_branch_name(pull_request)
+		head = get_ref_sha('refs/heads/%s' % branch_name)
+
+		if head is None:
+			fetch_pull_request(pull_request)
+			head = get_ref_sha('refs/heads/%s' % branch_name)
+
+		heads.append(head)
+
+	results = run_parallel(lambda head: get_merge_conflicts(base, head), heads)
+
+	conflicting = 0
+
+	for pull_request, conflicts in zip(pull_requests, results):
+		display_pull_request_minimal(pull_request)
+
+		if conflicts:
+			conflicting += 1
+			print color_text("	Conflicts with %s in:" % update_branch_option, 'error')
+
+			for path in conflicts:
+				print "		%s" % path
+		else:
+			print color_text("	Merges cleanly into %s" % update_branch_option, 'success')
+
+	print
+	print "%s of %s pull requests conflict with %s" % (conflicting, len(pull_requests), update_branch_option)
+	print
+	display_status()
+
 def command_close(repo_name, comment = None):
 	"""Closes the current pull request on github with the optional comment, then
 	deletes the branch."""
@@ -324,14 +747,173 @@ def command_close(repo_name, comment = None):
 
 	print color_text("Deleting branch %s" % branch_name, 'status')
 	ret = os.system('git branch -D %s' % branch_name)
+	invalidate_refs()
 	if ret != 0:
 		raise UserWarning("Could not delete branch")
 
+	remove_rendered_diffs(pull_request_ID)
+
 	print
 	print color_text("Pull request closed", 'success')
 	print
 	display_status()
 
+def command_commit_graph():
+	"""Reports whether the commit-graph is stale, and brings it up to date"""
+
+	print color_text("Checking the commit-graph", 'status')
+	print
+
+	layers = get_commit_graph_layers()
+
+	graph_commits = 0
+
+	for position, layer in enumerate(layers):
+		graph_commits += layer['commits']
+
+		if layer['bloom']:
+			bloom = "with changed-path Bloom filters"
+		else:
+			bloom = "without changed-path Bloom filters"
+
+		print "  Layer %s: %s commits %s" % (position + 1, layer['commits'], bloom)
+
+	commits = int(os.popen('git rev-list --all --count').read().strip() or 0)
+	missing = max(commits - graph_commits, 0)
+
+	print "  %s of %s reachable commits are missing from the commit-graph" % (missing, commits)
+	print
+
+	if missing > 0 or len(layers) == 0 or not all([layer['bloom'] for layer in layers]):
+		print color_text("The commit-graph is stale, updating it", 'warning')
+
+		update_commit_graph()
+
+		print color_text("Commit-graph updated", 'success')
+	else:
+		print color_text("The commit-graph is up to date", 'success')
+
+	print
+	display_status()
+
+def command_complete(words):
+	"""Prints the candidates for the last of the words, using only local data so
+	that it is fast enough to be run on every TAB"""
+
+	commands = (
+		'alias', 'check', 'close', 'commit-graph', 'continue-update', 'cu', 'diff', 'fetch',
+		'fetch-all', 'gc', 'help', 'info', 'info-detailed', 'merge', 'merge-order', 'open',
+		'overlap', 'pull', 'report', 'server', 'show-alias', 'stats', 'submit', 'update', 'update-users'
+	)
+
+	if len(words) == 0:
+		words = ['']
+
+	current = words[-1]
+	args = [word for word in words[:-1] if not word.startswith('-')]
+	previous = None
+
+	if len(words) >= 2:
+		previous = words[-2]
+
+	candidates = []
+
+	if previous in ('-u', '--reviewer', '-l', '--user'):
+		candidates = get_complete_aliases()
+	elif previous in ('-b', '--update-branch'):
+		candidates = get_complete_branches()
+	elif current.startswith('-'):
+		candidates = [
+			'--all', '--branches', '--dry-run', '--filter', '--format', '--help',
+			'--label', '--no-update', '--origin', '--pattern', '--quiet', '--remote',
+			'--repo', '--repos', '--restart', '--reviewer', '--stale-days', '--update', '--update-branch',
+			'--user'
+		]
+	elif len(args) == 0:
+		candidates = list(commands) + get_complete_pull_request_IDs()
+	elif args[0] in ('check', 'diff', 'fetch', 'open', 'overlap', 'stats', 'stat') and len(args) == 1:
+		candidates = get_complete_pull_request_IDs()
+	elif args[0] == 'update' and len(args) == 1:
+		candidates = get_complete_pull_request_IDs() + [branch for branch in get_complete_branches() if branch.startswith('pull-request-')]
+	elif args[0] == 'submit' and '--branches' in words:
+		candidates = get_complete_branches()
+	elif args[0] == 'server' and len(args) == 1:
+		candidates = ['start', 'status', 'stop']
+	elif args[0] == 'show-alias' and len(args) == 1:
+		candidates = get_complete_aliases()
+	elif args[0] == 'alias' and len(args) == 2:
+		get_users(True)
+		candidates = sorted(_users_by_login.keys())
+
+	for candidate in candidates:
+		if candidate.startswith(current):
+			print candidate
+
+def command_close_all(repo_name, pull_request_IDs = None, stale_days = None, label = None, comment = None, dry_run = False):
+	"""Closes the open pull requests matching the IDs, the number of days since
+	their last update and the label. Pull requests given by ID are closed
+	whatever their base branch."""
+
+	print color_text("Closing pull requests", 'status')
+	print
+
+	pull_requests = get_pull_requests(repo_name, options['filter-by-update-branch'] and not pull_request_IDs)
+
+	if pull_request_IDs:
+		pull_requests = [pull_request for pull_request in pull_requests if pull_request['number'] in pull_request_IDs]
+
+		found_IDs = [pull_request['number'] for pull_request in pull_requests]
+
+		for pull_request_ID in pull_request_IDs:
+			if pull_request_ID not in found_IDs:
+				print color_text("No open pull request %s found" % pull_request_ID, 'warning')
+
+	if stale_days is not None:
+		pull_requests = [pull_request for pull_request in pull_requests if get_pull_request_age(pull_request, 'updated_at') >= stale_days]
+
+	if label is not None:
+		pull_requests = [pull_request for pull_request in pull_requests if label in get_pull_request_labels(pull_request)]
+
+	if len(pull_requests) == 0:
+		print "No matching open pull requests found"
+		print
+		display_status()
+		return
+
+	if dry_run:
+		for pull_request in pull_requests:
+			display_pull_request_minimal(pull_request)
+
+		print
+		print color_text("Would close %s pull requests" % len(pull_requests), 'success')
+		print
+		display_status()
+		return
+
+	def close(pull_request):
+		try:
+			check_interrupted()
+			close_pull_request(repo_name, pull_request['number'], comment)
+		except UserWarning, e:
+			return str(e)
+
+	errors = run_parallel(close, pull_requests)
+
+	print
+
+	for pull_request, error in zip(pull_requests, errors):
+		display_pull_request_minimal(pull_request)
+
+		if error is None:
+			print color_text("	Closed", 'success')
+		else:
+			print color_text("	%s" % error, 'error')
+
+	print
+	print "Closed %s of %s pull requests" % (errors.count(None), len(pull_requests))
+	print
+	display_status()
+
 def command_continue_update():
 	print color_text("Continuing update from %s" % options['update-branch'], 'status')
 
@@ -339,19 +921,142 @@ def command_continue_update():
 	print
 	display_status()
 
-def command_fetch_all(repo_name):
+def command_diff(pull_request_ID = None):
+	"""Displays the review diff of the fetched pull request, or of the current
+	pull request branch"""
+
+	if pull_request_ID is None:
+		branch_name = get_current_branch_name()
+	else:
+		if not pull_request_ID.isdigit():
+			raise UserWarning("Invalid pull request ID: %s" % pull_request_ID)
+
+		branch_names = [ref.replace('refs/heads/', '', 1) for ref in get_refs('refs/heads/pull-request-%s' % pull_request_ID)]
+		branch_names = [branch_name for branch_name in branch_names if get_pull_request_ID(branch_name) == int(pull_request_ID)]
+
+		if len(branch_names) == 0:
+			raise UserWarning("Pull request %s has not been fetched" % pull_request_ID)
+
+		branch_name = branch_names[0]
+
+	diff = render_diff(branch_name)
+
+	if options['enable-color'] != True or not detect_terminal()['isatty']:
+		diff = re.sub('\033\[[0-9;]*m', '', diff)
+
+	begin_output()
+
+	try:
+		sys.stdout.write(diff)
+	finally:
+		end_output()
+
+def command_fetch_all(repo_name, restart = False):
 	"""Fetches all pull requests into local branches"""
 
 	print color_text("Fetching all pull requests", 'status')
 	print
 
 	pull_requests = get_pull_requests(repo_name, options['filter-by-update-branch'])
+	branch_names = []
+
+	def fetch(pull_request):
+		branch_name = fetch_pull_request(pull_request)
+		branch_names.append(branch_name)
+
+		if _record_stream is not None:
+			emit_record('fetch', [
+				('number', pull_request['number']),
+				('branch', branch_name),
+				('head', get_ref_sha('refs/heads/%s' % branch_name))
+			])
+		else:
+			display_pull_request_minimal(pull_request)
+			print
 
-	for pull_request in pull_requests:
-		fetch_pull_request(pull_request)
-		display_pull_request_minimal(pull_request)
+	failures = run_batch('fetch-all', repo_name, pull_requests, fetch, restart)
+
+	render_diffs_in_background(branch_names)
+
+	display_status()
+
+	if failures:
+		raise UserWarning("%s of %s pull requests could not be fetched, run the command again to retry them" % (len(failures), len(pull_requests)))
+
+def command_gc(repo_name, prune_origin = False, dry_run = False):
+	"""Deletes the local pull request branches of pull requests that are no
+	longer open in a single ref transaction"""
+
+	print color_text("Deleting branches of closed pull requests", 'status')
+	print
+
+	pull_request_IDs = set([pull_request['number'] for pull_request in get_pull_requests(repo_name)])
+	current_branch = get_current_branch_name(False)
+
+	stale_refs = []
+
+	for ref in get_refs('refs/heads/pull-request-'):
+		branch_name = ref.replace('refs/heads/', '', 1)
+
+		pull_request_ID = get_pull_request_ID(branch_name)
+
+		# Branches like pull-request-foo were not created by fetch
+		if branch_name == current_branch or pull_request_ID is None:
+			continue
+
+		if pull_request_ID not in pull_request_IDs:
+			stale_refs.append(ref)
+
+	if len(stale_refs) == 0:
+		print "No branches of closed pull requests found"
+		print
+		display_status()
+		return
+
+	for ref in stale_refs:
+		print "	%s" % ref.replace('refs/heads/', '', 1)
+
+	print
+
+	if dry_run:
+		print color_text("Would delete %s branches" % len(stale_refs), 'success')
 		print
+		display_status()
+		return
+
+	commands = ''.join(['delete %s %s\n' % (ref, get_ref_sha(ref)) for ref in stale_refs])
+
+	process = subprocess.Popen(['git', 'update-ref', '--stdin'], stdin=subprocess.PIPE)
+	process.communicate(commands)
+
+	invalidate_refs()
+
+	if process.returncode != 0:
+		raise UserWarning("Could not delete branches")
+
+	for ref in stale_refs:
+		remove_rendered_diffs(get_pull_request_ID(ref.replace('refs/heads/', '', 1)))
+
+	if prune_origin:
+		refspecs = []
+
+		for ref in stale_refs:
+			branch_name = ref.replace('refs/heads/', '', 1)
 
+			if get_ref_sha('refs/remotes/origin/%s' % branch_name) is not None:
+				refspecs.append(':%s' % branch_name)
+
+		if refspecs:
+			print color_text("Deleting %s branches from origin" % len(refspecs), 'status')
+
+			ret = os.system('git push origin %s' % ' '.join(refspecs))
+			if ret != 0:
+				raise UserWarning("Could not delete branches from origin")
+
+			invalidate_refs()
+
+	print color_text("Deleted %s branches" % len(stale_refs), 'success')
+	print
 	display_status()
 
 def command_help():
@@ -365,25 +1070,16 @@ def command_info(username, detailed = False):
 	data = github_json_request(url)
 	repos = data['repositories']
 	# print json.dumps(data,sort_keys=True, indent=4)
-	total = 0
-
-	for pull_request_info in repos:
-		issue_count = pull_request_info['open_issues']
-
-		if issue_count > 0:
-			base_name = pull_request_info['name']
-			repo_name = "%s/%s" % (pull_request_info['owner'], base_name)
 
-			print "  %s: %s" % (color_text(base_name, 'display-info-repo-title'), color_text(issue_count, 'display-info-repo-count'))
-
-			if detailed:
-				pull_requests = get_pull_requests(repo_name, options['filter-by-update-branch'])
+	begin_output()
 
-				for pull_request in pull_requests:
-					name = (pull_request['user'].get('name') or pull_request['user'].get('login')).encode('utf-8')
-					print "    %s by %s" % (color_text("REQ %s" % pull_request.get('number'), 'display-title-number', True), color_text(name, 'display-title-user'))
+	try:
+		total = display_info_repos(repos, detailed)
+	finally:
+		end_output()
 
-			total += issue_count
+	if _record_stream is not None:
+		emit_record('total', [('user', username), ('open_issues', total)])
 
 	print "-"
 	out = "%s: %s" % (color_text("Total pull requests", 'display-info-total-title', True), color_text(total, 'display-info-total-count', True))
@@ -413,9 +1109,12 @@ def command_merge(repo_name, comment = None):
 
 	print color_text("Deleting branch %s" % branch_name, 'status')
 	ret = os.system('git branch -D %s' % branch_name)
+	invalidate_refs()
 	if ret != 0:
 		raise UserWarning("Could not delete branch")
 
+	remove_rendered_diffs(pull_request_ID)
+
 	if options['merge-auto-close']:
 		print color_text("Closing pull request", 'status')
 		close_pull_request(repo_name, pull_request_ID, comment)
@@ -425,6 +1124,32 @@ def command_merge(repo_name, comment = None):
 	print
 	display_status()
 
+def command_merge_order(repo_name):
+	"""Suggests an order to merge the open pull requests in, starting with the
+	ones that touch the fewest files shared with other pull requests"""
+
+	print color_text("Suggesting a merge order for %s" % options['update-branch'], 'status')
+	print
+
+	pull_requests = get_indexed_pull_requests(repo_name)
+
+	pull_request_IDs = [pull_request['number'] for pull_request in pull_requests]
+	overlaps = {}
+
+	for pull_request_ID in pull_request_IDs:
+		overlaps[pull_request_ID] = get_overlapping_pull_requests(pull_request_ID, pull_request_IDs)
+
+	indexed_pulls = _file_index['pulls']
+
+	pull_requests.sort(key=lambda pull_request: (len(overlaps[pull_request['number']]), len(indexed_pulls[str(pull_request['number'])]['files']), pull_request['number']))
+
+	for position, pull_request in enumerate(pull_requests):
+		pull_request_ID = pull_request['number']
+		print "%3d. %s (overlaps with %s)" % (position + 1, color_text("REQUEST %s" % pull_request_ID, 'display-title-number', True), len(overlaps[pull_request_ID]))
+
+	print
+	display_status()
+
 def command_open(repo_name, pull_request_ID = None):
 	"""Open a pull request in the browser"""
 
@@ -436,45 +1161,339 @@ def command_open(repo_name, pull_request_ID = None):
 
 	open_URL(pull_request.get('html_url'))
 
-def command_show(repo_name):
-	"""List open pull requests
+def command_overlap(repo_name, pull_request_ID = None):
+	"""Lists the open pull requests that change the same files as the specified
+	pull request, or as each other"""
 
-	Queries the github API for open pull requests in the current repo.
-	"""
+	print color_text("Finding overlapping pull requests", 'status')
+	print
 
-	update_branch_name = options['update-branch']
-	filter_by_update_branch = options['filter-by-update-branch']
+	pull_requests = get_indexed_pull_requests(repo_name)
 
-	if not filter_by_update_branch:
-		update_branch_name = "across all branches"
-	else:
-		update_branch_name = "on branch '%s'" % update_branch_name
+	pull_request_IDs = [pull_request['number'] for pull_request in pull_requests]
 
-	print color_text("Loading open pull requests for %s %s" % (repo_name, update_branch_name), 'status')
-	print
+	if pull_request_ID is not None:
+		pull_request_ID = int(pull_request_ID)
 
-	pull_requests = get_pull_requests(repo_name, filter_by_update_branch)
+		if pull_request_ID not in pull_request_IDs:
+			raise UserWarning("Pull request %s is not open or has not been fetched" % pull_request_ID)
 
-	if len(pull_requests) == 0:
-		print "No open pull requests found"
+		pull_requests = [pull_request for pull_request in pull_requests if pull_request['number'] == pull_request_ID]
+
+	found = False
 
 	for pull_request in pull_requests:
-		display_pull_request(pull_request)
+		overlaps = get_overlapping_pull_requests(pull_request['number'], pull_request_IDs)
+
+		if not overlaps:
+			continue
+
+		found = True
+
+		display_pull_request_minimal(pull_request)
+
+		for overlap_ID, paths in sorted(overlaps.items()):
+			print "	%s: %s" % (color_text("REQUEST %s" % overlap_ID, 'display-title-number'), ', '.join(sorted(paths)))
+
+		print
+
+	if not found:
+		print "No overlapping pull requests found"
+		print
 
 	display_status()
 
+def command_render_diffs(update_branch, branch_names):
+	"""Renders the review diffs of the pull request branches against the
+	update-branch, for render_diffs_in_background"""
+
+	options['update-branch'] = update_branch
+
+	for branch_name in branch_names:
+		try:
+			render_diff(branch_name)
+		except UserWarning:
+			pass
+
+def command_repos(repo_paths, args, default_options, option_overrides, remote = False, restart = False):
+	"""Runs the command over several local repositories, sharing the github
+	responses and rate limit between them and doing the git work in parallel
+	processes"""
+
+	global _rate_limit_remaining, _rate_limit_shared
+
+	if len(args) > 0 and args[0] not in ('fetch-all', 'stats', 'stat'):
+		raise UserWarning("The --repos option only supports the #no command#, stats and fetch-all commands")
+
+	repos = []
+	original_dir_path = os.getcwd()
+
+	for repo_path in repo_paths:
+		os.chdir(repo_path)
+		reset_repo_state()
+
+		options.clear()
+		options.update(default_options)
+		load_options()
+		options.update(option_overrides)
+
+		repos.append((repo_path, get_default_repo_name(), dict(options)))
+
+	os.chdir(original_dir_path)
+	reset_repo_state()
+
+	print color_text("Loading open pull requests for %s repositories" % len(repos), 'status')
+	print
+
+	# Load the pull requests of all the repositories up front, so that the
+	# processes doing the git work share the responses
+	run_parallel(lambda repo: github_json_request(get_pull_requests_url(repo[1])), repos)
+
+	# The processes inherit it, -1 while github has not reported the limit
+	_rate_limit_shared = multiprocessing.Value('i', -1)
+
+	if _rate_limit_remaining is not None:
+		_rate_limit_shared.value = _rate_limit_remaining
+
+	pool = multiprocessing.Pool(min(int(options['parallel-jobs']), len(repos)))
+
+	try:
+		results = pool.map(run_repo_command, [(repo_path, repo_name, repo_options, args, remote, restart) for repo_path, repo_name, repo_options in repos])
+	finally:
+		pool.close()
+
+		if _rate_limit_shared.value >= 0:
+			_rate_limit_remaining = _rate_limit_shared.value
+
+		_rate_limit_shared = None
+
+	for (repo_path, repo_name, repo_options), (output, records, pull_request_count, error) in zip(repos, results):
+		print color_text("%s (%s)" % (repo_name, repo_path), 'display-info-repo-title', True)
+		print output
+
+		# Written here so that the tsv header of each type comes once
+		for record_type, fields in records:
+			emit_record(record_type, fields)
+
+	print "-"
+
+	total = 0
+
+	for (repo_path, repo_name, repo_options), (output, records, pull_request_count, error) in zip(repos, results):
+		if error is None:
+			print "  %s: %s" % (color_text(repo_name, 'display-info-repo-title'), color_text(pull_request_count, 'display-info-repo-count'))
+			total += pull_request_count
+		else:
+			print "  %s: %s" % (color_text(repo_name, 'display-info-repo-title'), color_text(error, 'error'))
+
+	print "%s: %s" % (color_text("Total pull requests", 'display-info-total-title', True), color_text(total, 'display-info-total-count', True))
+
+def command_report(repo_name, remote = False):
+	"""Displays the open pull requests and their changes aggregated by author,
+	base branch, file extension and age, in a single pass over the pull
+	requests reusing their cached stats. Authors are labelled with their user
+	aliases, and a login that is an alias of another login is counted under
+	it."""
+
+	print color_text("Loading the workload report for %s" % repo_name, 'status')
+	print
+
+	pull_requests = get_pull_requests(repo_name, options['filter-by-update-branch'])
+
+	if remote:
+		load_remote_pull_request_stats(repo_name, pull_requests)
+
+	users = get_users(True)
+
+	def get_aliases(login):
+		return ', '.join(sorted([alias for alias in _users_by_login.get(login, []) if alias != login]))
+
+	age_buckets = ((7, '< 1 week'), (30, '1-4 weeks'), (90, '1-3 months'), (None, '> 3 months'))
+
+	groups = OrderedDict([('author', {}), ('base', {}), ('extension', {}), ('age', {})])
+
+	def add(group, key, files, insertions = None, deletions = None):
+		row = groups[group].setdefault(key, {'pull_requests': 0, 'files': 0, 'insertions': 0, 'deletions': 0})
+
+		row['pull_requests'] += 1
+		row['files'] += files
+
+		if insertions is None:
+			row['insertions'] = row['deletions'] = None
+		else:
+			row['insertions'] += insertions
+			row['deletions'] += deletions
+
+	for pull_request in pull_requests:
+		stats = None
+
+		if remote:
+			stats = get_pull_request_stats(pull_request, False) or get_remote_pull_request_stats(repo_name, pull_request)
+
+		if stats is None:
+			stats = get_pull_request_stats(pull_request)
+
+		files = len(stats['files'])
+
+		login = pull_request['user'].get('login')
+
+		add('author', users.get(login, login), files, stats['insertions'], stats['deletions'])
+		add('base', pull_request['base']['ref'], files, stats['insertions'], stats['deletions'])
+
+		for extension, count in stats['extensions'].items():
+			add('extension', extension, count)
+
+		age = get_pull_request_age(pull_request)
+
+		for days, bucket in age_buckets:
+			if days is None or age <= days:
+				break
+
+		add('age', bucket, files, stats['insertions'], stats['deletions'])
+
+	save_stats_cache()
+	save_file_index()
+
+	bucket_order = [bucket for days, bucket in age_buckets]
+
+	def sort_key(group, key, row):
+		if group == 'age':
+			return bucket_order.index(key)
+
+		return (-row['pull_requests'], key)
+
+	begin_output()
+
+	try:
+		for group, rows in groups.items():
+			keys = sorted(rows.keys(), key=lambda key: sort_key(group, key, rows[key]))
+
+			if _record_stream is not None:
+				for key in keys:
+					row = rows[key]
+
+					aliases = ''
+
+					if group == 'author':
+						aliases = get_aliases(key)
+
+					emit_record('report', [
+						('group', group),
+						('key', key),
+						('aliases', aliases),
+						('pull_requests', row['pull_requests']),
+						('files', row['files']),
+						('insertions', row['insertions']),
+						('deletions', row['deletions'])
+					])
+
+				continue
+
+			print color_text("%-24s %6s %7s %9s %9s" % (group.capitalize(), 'PRs', 'Files', '+', '-'), 'display-info-total-title', True)
+
+			for key in keys:
+				row = rows[key]
+
+				insertions, deletions = row['insertions'], row['deletions']
+
+				if insertions is None:
+					insertions = deletions = ''
+
+				line = "  %-22s %6d %7d %9s %9s" % (key[:22], row['pull_requests'], row['files'], insertions, deletions)
+
+				if group == 'author' and get_aliases(key):
+					line += "  (%s)" % get_aliases(key)
+
+				print line
+
+			print
+	finally:
+		end_output()
+
+	print "%s: %s" % (color_text("Total pull requests", 'display-info-total-title', True), color_text(len(pull_requests), 'display-info-total-count', True))
+
+def command_server(action, default_options):
+	"""Starts or stops the gitpr server, or displays whether it is running"""
+
+	if _server_relay is not None:
+		raise UserWarning("The server command cannot be run through the gitpr server")
+
+	socket_path = get_server_socket_path()
+
+	if action == 'stop':
+		status = request_server(socket_path, 'stop')
+	else:
+		status = request_server(socket_path, 'status')
+
+	if action == 'start':
+		if status is not None:
+			print color_text("The gitpr server is already running (pid %s)" % status['pid'], 'warning')
+			return
+
+		start_server(socket_path, default_options)
+	elif action == 'stop':
+		if status is None:
+			print color_text("The gitpr server is not running", 'warning')
+		else:
+			print color_text("Stopped the gitpr server (pid %s)" % status['pid'], 'success')
+	elif action == 'status':
+		if status is None:
+			print "The gitpr server is not running"
+		else:
+			print "The gitpr server is running (pid %s) on %s, %s commands served since %s" % (status['pid'], socket_path, status['requests'], time.ctime(status['started']))
+	else:
+		raise UserWarning("Invalid server action: %s" % action)
+
+def command_show(repo_name):
+	"""List open pull requests
+
+	Queries the github API for open pull requests in the current repo.
+	"""
+
+	update_branch_name = options['update-branch']
+	filter_by_update_branch = options['filter-by-update-branch']
+
+	if not filter_by_update_branch:
+		update_branch_name = "across all branches"
+	else:
+		update_branch_name = "on branch '%s'" % update_branch_name
+
+	print color_text("Loading open pull requests for %s %s" % (repo_name, update_branch_name), 'status')
+	print
+
+	pull_requests = get_pull_requests(repo_name, filter_by_update_branch)
+
+	begin_output()
+
+	try:
+		if len(pull_requests) == 0:
+			print "No open pull requests found"
+
+		for pull_request in pull_requests:
+			if _record_stream is not None:
+				emit_record('pull_request', get_pull_request_fields(pull_request))
+			else:
+				display_pull_request(pull_request)
+
+		display_status()
+	finally:
+		end_output()
+
 def command_show_alias(alias):
 	""" Shows the username where the alias points to
 	"""
 
-	user_item = next((user for user in users.iteritems() if user[0] == alias or user[1] == alias), None)
+	users = get_users()
 
-	if user_item:
-		print "The user alias %s points to %s " % user_item
+	if alias in users:
+		print "The user alias %s points to %s " % (alias, users[alias])
+	elif alias in _users_by_login:
+		for user_alias in sorted(_users_by_login[alias]):
+			print "The user alias %s points to %s " % (user_alias, alias)
 	else:
 		print "There is no user alias or github name matching %s in the current mapping file" % alias
 
-def get_pr_stats(repo_name, pull_request_ID):
+def get_pr_stats(repo_name, pull_request_ID, remote = False, restart = False):
 	if pull_request_ID != None:
 		is_int = False
 		try:
@@ -483,27 +1502,33 @@ def get_pr_stats(repo_name, pull_request_ID):
 		except Exception, e:
 			pull_request = pull_request_ID
 
-		display_pull_request_minimal(pull_request)
+		pull_requests = [pull_request]
+	else:
+		pull_requests = get_pull_requests(repo_name, options['filter-by-update-branch'])
 
-		branch_name = build_branch_name(pull_request)
-		ret = os.system('git show-ref --verify -q refs/heads/%s' % branch_name)
+	remote_repo_name = None
 
-		if ret != 0:
-			branch_name = fetch_pull_request(pull_request)
+	if remote:
+		remote_repo_name = repo_name
 
-			ret = os.system('git show-ref --verify -q refs/heads/%s' % branch_name)
+		load_remote_pull_request_stats(repo_name, pull_requests)
 
-			if  ret != 0:
-				raise UserWarning("Fetch failed")
+	failures = []
 
-		merge_base = os.popen('git merge-base %s %s' % (options['update-branch'], branch_name)).read().strip()
-		ret = os.system("git --no-pager diff --shortstat {0}..{1} && git diff --numstat --pretty='%H' --no-renames {0}..{1} | xargs -0n1 echo -n | awk '{{print $3}}' | sed -e 's/^.*\.\(.*\)$/\\1/' | sort | uniq -c | tr '\n' ',' | sed 's/,$//'".format(merge_base, branch_name))
-		print
-	else:
-		pull_requests = get_pull_requests(repo_name, options['filter-by-update-branch'])
+	try:
+		if pull_request_ID != None:
+			display_pr_stats(pull_requests[0], remote_repo_name)
+		else:
+			# The stats of the pull requests already done come from the stats cache
+			display = lambda pull_request: display_pr_stats(pull_request, remote_repo_name)
 
-		for pull_request in pull_requests:
-			get_pr_stats(repo_name, pull_request)
+			failures = run_batch('stats', repo_name, pull_requests, display, restart, display)
+	finally:
+		save_stats_cache()
+		save_file_index()
+
+	if failures:
+		raise UserWarning("The stats of %s of %s pull requests could not be loaded, run the command again to retry them" % (len(failures), len(pull_requests)))
 
 def command_submit(repo_name, username, reviewer_repo_name = None, pull_body = None, pull_title = None, submitOpenGitHub = True):
 	"""Push the current branch and create a pull request to your github reviewer
@@ -513,14 +1538,7 @@ def command_submit(repo_name, username, reviewer_repo_name = None, pull_body = N
 
 	print color_text("Submitting pull request for %s" % branch_name, 'status')
 
-	if reviewer_repo_name is None or reviewer_repo_name == '':
-		reviewer_repo_name = get_repo_name_for_remote('upstream')
-
-	if reviewer_repo_name is None or reviewer_repo_name == '':
-		raise UserWarning("Could not determine a repo to submit this pull request to")
-
-	if '/' not in reviewer_repo_name:
-		reviewer_repo_name = repo_name.replace(username, reviewer_repo_name)
+	reviewer_repo_name = get_reviewer_repo_name(repo_name, username, reviewer_repo_name)
 
 	print color_text("Pushing local branch %s to origin" % branch_name, 'status')
 
@@ -529,32 +1547,9 @@ def command_submit(repo_name, username, reviewer_repo_name = None, pull_body = N
 	if ret != 0:
 		raise UserWarning("Could not push this branch to your origin")
 
-	url = "http://github.com/api/v2/json/pulls/%s" % reviewer_repo_name
-
-	# pull[base] - A String of the branch or commit SHA that you want your changes to be pulled to.
-	# pull[head] - A String of the branch or commit SHA of your changes. Typically this will be a branch. If the branch is in a fork of the original repository, specify the username first: "my-user:some-branch".
-	# pull[title] - The String title of the Pull Request (and the related Issue).
-	# pull[body] - The String body of the Pull Request.
-
-	if pull_title == None or pull_title == '':
-		pull_title = build_pull_request_title(branch_name)
-
-	if pull_body == None:
-		pull_body = ''
-		# pull_body = raw_input("Comment: ").strip()
-
-	params = {
-		'pull[base]': options['update-branch'],
-		'pull[head]': "%s:%s" % (username, branch_name),
-		'pull[title]': pull_title,
-		'pull[body]': pull_body
-	}
-
 	print color_text("Sending pull request to %s" % reviewer_repo_name, 'status')
 
-	data = github_json_request(url, params)
-
-	pull_request = data['pull']
+	pull_request = create_pull_request(reviewer_repo_name, username, branch_name, pull_body, pull_title)
 
 	print
 	display_pull_request(pull_request)
@@ -567,6 +1562,81 @@ def command_submit(repo_name, username, reviewer_repo_name = None, pull_body = N
 	if submitOpenGitHub:
 		open_URL(pull_request.get('html_url'))
 
+def command_submit_all(repo_name, username, reviewer_repo_name = None, branch_names = None, pattern = None, pull_body = None):
+	"""Pushes several branches at once and creates a pull request for each of
+	them"""
+
+	branch_names = list(branch_names or [])
+
+	if pattern is not None:
+		for ref in get_refs('refs/heads/'):
+			branch_name = ref.replace('refs/heads/', '', 1)
+
+			if fnmatch.fnmatch(branch_name, pattern) and branch_name not in branch_names:
+				branch_names.append(branch_name)
+
+	if len(branch_names) == 0:
+		raise UserWarning("No branches to submit")
+
+	for branch_name in branch_names:
+		if get_ref_sha('refs/heads/%s' % branch_name) is None:
+			raise UserWarning("Invalid branch: %s" % branch_name)
+
+	reviewer_repo_name = get_reviewer_repo_name(repo_name, username, reviewer_repo_name)
+
+	print color_text("Submitting pull requests for %s branches to %s" % (len(branch_names), reviewer_repo_name), 'status')
+	print
+
+	# Only push the branches that are not already up to date on origin
+	remote_heads = {}
+
+	for line in os.popen('git ls-remote origin %s' % ' '.join(['refs/heads/%s' % branch_name for branch_name in branch_names])).read().splitlines():
+		sha, ref = line.split('\t', 1)
+		remote_heads[ref.replace('refs/heads/', '', 1)] = sha
+
+	push_branch_names = [branch_name for branch_name in branch_names if remote_heads.get(branch_name) != get_ref_sha('refs/heads/%s' % branch_name)]
+
+	if push_branch_names:
+		print color_text("Pushing %s branches to origin" % len(push_branch_names), 'status')
+
+		ret = os.system('git push origin %s' % ' '.join(push_branch_names))
+
+		if ret != 0:
+			raise UserWarning("Could not push the branches to your origin")
+
+		invalidate_refs()
+
+	def submit(branch_name):
+		try:
+			return create_pull_request(reviewer_repo_name, username, branch_name, pull_body)
+		except UserWarning, e:
+			return str(e)
+		except KeyError:
+			return "Invalid response from github"
+
+	results = run_parallel(submit, branch_names)
+
+	print
+
+	submitted = 0
+
+	for branch_name, result in zip(branch_names, results):
+		if branch_name in push_branch_names:
+			pushed = "pushed"
+		else:
+			pushed = "already up to date"
+
+		if isinstance(result, dict):
+			submitted += 1
+			print "%s (%s): %s" % (branch_name, pushed, color_text(result.get('html_url'), 'display-title-url'))
+		else:
+			print "%s (%s): %s" % (branch_name, pushed, color_text(result, 'error'))
+
+	print
+	print color_text("%s of %s pull requests submitted" % (submitted, len(branch_names)), 'success')
+	print
+	display_status()
+
 def command_update(repo_name, target = None):
 	if target == None:
 		branch_name = get_current_branch_name()
@@ -584,7 +1654,7 @@ def command_update(repo_name, target = None):
 	print
 	display_status()
 
-def command_update_users(filename):
+def command_update_users():
 
 	upstream_forks = github_json_request("http://github.com/api/v2/json/repos/show/%s/network" % get_repo_name_for_remote("upstream"))
 
@@ -605,10 +1675,16 @@ def command_update_users(filename):
 
 		github_users[email] = login
 
-	github_users_file = open(filename, 'w')
-	json.dump(github_users, github_users_file)
+	users_alias_file = get_users_alias_file()
+	lock_file = lock_path(users_alias_file)
+
+	try:
+		write_json_file(users_alias_file, github_users)
 
-	github_users_file.close()
+		if os.path.exists('%s.journal' % users_alias_file):
+			os.remove('%s.journal' % users_alias_file)
+	finally:
+		lock_file.close()
 
 	return github_users
 
@@ -660,6 +1736,8 @@ def complete_update(branch_name):
 			if ret != 0:
 				raise UserWarning("Could not checkout %s" % branch_name)
 
+	set_update_progress(get_work_dir(), None)
+
 	print
 	print color_text("Updating %s from %s complete" % (branch_name, update_branch_option), 'success')
 
@@ -677,62 +1755,387 @@ def continue_update():
 
 	complete_update(branch_name)
 
-def display_pull_request(pull_request):
-	"""Nicely display_pull_request info about a given pull request"""
-
-	display_pull_request_minimal(pull_request)
-	print "	%s" % color_text(pull_request.get('html_url'), 'display-title-url')
+def create_pull_request(reviewer_repo_name, username, branch_name, pull_body = None, pull_title = None):
+	"""Creates a pull request for the branch, which must have been pushed to
+	origin, and returns it"""
 
-	# print json.dumps(pull_request,sort_keys=True, indent=4)
-	if pull_request.get('body').strip():
-		print fill(pull_request.get('body'), initial_indent="	", subsequent_indent="	", width=80)
+	url = "http://github.com/api/v2/json/pulls/%s" % reviewer_repo_name
 
-	# print "   Created: %s" % date.strftime(isodate.parse_datetime( pull_request.get('issue_created_at')), "%B %d, %Y at %I:%M %p")
-	# print "   Created: %s" % pull_request.get('issue_created_at')
-	# print isodate.parse_datetime( pull_request.get('issue_created_at'), "%Y-%m-%dT%H:%M:%S" )
+	# pull[base] - A String of the branch or commit SHA that you want your changes to be pulled to.
+	# pull[head] - A String of the branch or commit SHA of your changes. Typically this will be a branch. If the branch is in a fork of the original repository, specify the username first: "my-user:some-branch".
+	# pull[title] - The String title of the Pull Request (and the related Issue).
+	# pull[body] - The String body of the Pull Request.
 
-	print
+	if pull_title == None or pull_title == '':
+		pull_title = build_pull_request_title(branch_name)
 
-def display_pull_request_minimal(pull_request):
-	"""Display minimal info about a given pull request"""
+	if pull_body == None:
+		pull_body = ''
+		# pull_body = raw_input("Comment: ").strip()
 
-	print "%s - %s by %s (%s)" % (color_text("REQUEST %s" % pull_request.get('number'), 'display-title-number', True), color_text(pull_request.get('title'), 'display-title-text', True), color_text(pull_request['user'].get('name'), 'display-title-user'), pull_request['user'].get('login'))
+	params = {
+		'pull[base]': options['update-branch'],
+		'pull[head]': "%s:%s" % (username, branch_name),
+		'pull[title]': pull_title,
+		'pull[body]': pull_body
+	}
 
-def display_status():
-	"""Displays the current branch name"""
+	data = github_json_request(url, params)
 
-	branch_name = get_current_branch_name(False)
-	out = "Current branch: %s" % branch_name
-	print out
-	return out
+	return data['pull']
 
-def fetch_pull_request(pull_request):
-	"""Fetches a pull request into a local branch, and returns the name of the
-	local branch"""
+def display_info_repos(repos, detailed = False):
+	"""Displays the number of pull requests open on each of the repositories,
+	and returns the total"""
 
-	branch_name = build_branch_name(pull_request)
-	repo_url = get_repo_url(pull_request)
+	total = 0
 
-	remote_branch_name = pull_request['head']['ref']
+	for pull_request_info in repos:
+		issue_count = pull_request_info['open_issues']
 
+		if issue_count > 0:
+			base_name = pull_request_info['name']
+			repo_name = "%s/%s" % (pull_request_info['owner'], base_name)
 
-	# print json.dumps(pull_request,sort_keys=True, indent=4)
+			if _record_stream is not None:
+				emit_record('repo', [('repo', repo_name), ('open_issues', issue_count)])
+			else:
+				print "  %s: %s" % (color_text(base_name, 'display-info-repo-title'), color_text(issue_count, 'display-info-repo-count'))
 
-	ret = os.system('git fetch %s %s:%s' % (repo_url, remote_branch_name, branch_name))
+			if detailed:
+				pull_requests = get_pull_requests(repo_name, options['filter-by-update-branch'])
 
-	if ret != 0:
-		ret = os.system('git show-ref --verify refs/heads/%s' % branch_name)
+				for pull_request in pull_requests:
+					if _record_stream is not None:
+						emit_record('pull_request', get_pull_request_fields(pull_request))
+						continue
 
-	if ret != 0:
+					name = (pull_request['user'].get('name') or pull_request['user'].get('login')).encode('utf-8')
+					print "    %s by %s" % (color_text("REQ %s" % pull_request.get('number'), 'display-title-number', True), color_text(name, 'display-title-user'))
+
+			total += issue_count
+
+	return total
+
+def display_pr_stats(pull_request, remote_repo_name = None):
+	"""Displays a pull request along with the stats of its changes, fetching it
+	first if needed. If remote_repo_name is given the stats are loaded from
+	github instead, unless the pull request has too many files."""
+
+	if _record_stream is not None:
+		stats = get_display_pr_stats(pull_request, remote_repo_name)
+
+		emit_record('stats', [
+			('number', pull_request['number']),
+			('files', len(stats['files'])),
+			('insertions', stats['insertions']),
+			('deletions', stats['deletions']),
+			('extensions', stats['extensions'])
+		])
+
+		return
+
+	display_pull_request_minimal(pull_request)
+
+	stats = get_display_pr_stats(pull_request, remote_repo_name)
+
+	print stats['shortstat']
+	print ','.join(["%7d %s" % (count, extension) for extension, count in sorted(stats['extensions'].items())])
+
+def display_pull_request(pull_request):
+	"""Nicely display_pull_request info about a given pull request"""
+
+	display_pull_request_minimal(pull_request)
+	print "	%s" % color_text(pull_request.get('html_url'), 'display-title-url')
+
+	# print json.dumps(pull_request,sort_keys=True, indent=4)
+	body = (pull_request.get('body') or '').strip()
+
+	if body and options['display-body'] != 'none':
+		if options['display-body'] == 'truncate':
+			first_line = body.splitlines()[0]
+
+			if len(first_line) > 160 or first_line != body:
+				body = "%s..." % first_line[:160]
+
+		print fill(body, initial_indent="	", subsequent_indent="	", width=80)
+
+	# print "   Created: %s" % date.strftime(isodate.parse_datetime( pull_request.get('issue_created_at')), "%B %d, %Y at %I:%M %p")
+	# print "   Created: %s" % pull_request.get('issue_created_at')
+	# print isodate.parse_datetime( pull_request.get('issue_created_at'), "%Y-%m-%dT%H:%M:%S" )
+
+	print
+
+def detect_terminal():
+	"""Returns whether the output goes to a terminal and the number of rows of
+	the terminal, detected only once"""
+
+	global _terminal
+
+	if _terminal is None:
+		stream = sys.stdout
+
+		if _output_buffer is not None:
+			stream = _output_stream
+
+		isatty = stream.isatty()
+		rows = 0
+
+		if isatty:
+			try:
+				rows = struct.unpack('hh', fcntl.ioctl(stream.fileno(), termios.TIOCGWINSZ, '1234'))[0]
+			except IOError:
+				pass
+
+		_terminal = {'isatty': isatty, 'rows': rows}
+
+	return _terminal
+
+def display_pull_request_minimal(pull_request):
+	"""Display minimal info about a given pull request"""
+
+	print "%s - %s by %s (%s)" % (color_text("REQUEST %s" % pull_request.get('number'), 'display-title-number', True), color_text(pull_request.get('title'), 'display-title-text', True), color_text(pull_request['user'].get('name'), 'display-title-user'), pull_request['user'].get('login'))
+
+def display_status():
+	"""Displays the current branch name"""
+
+	branch_name = get_current_branch_name(False)
+	out = "Current branch: %s" % branch_name
+	print out
+	return out
+
+def begin_output():
+	"""Collects the output in a buffer until end_output is called, so that long
+	listings are written at once or sent to a pager"""
+
+	global _output_buffer, _output_stream
+
+	if _output_buffer is not None or _record_stream is not None:
+		return
+
+	detect_terminal()
+
+	_output_stream = sys.stdout
+	_output_buffer = OutputBuffer()
+
+	sys.stdout = _output_buffer
+
+def emit_record(record_type, fields):
+	"""Writes a record of the type, made of the (name, value) pairs of fields, to
+	the record stream in the format set by the 'format' option"""
+
+	# Collected by run_repo_command, the parent process writes them along with
+	# the records of the other repositories
+	if _record_list is not None:
+		_record_list.append((record_type, fields))
+		return
+
+	if options['format'] == 'tsv':
+		def tsv_value(value):
+			if isinstance(value, dict):
+				value = ','.join(['%s:%s' % item for item in sorted(value.items())])
+			elif value is None:
+				value = ''
+			elif not isinstance(value, basestring):
+				value = str(value)
+
+			return re.sub('[\t\r\n]+', ' ', value)
+
+		if record_type not in _record_types:
+			_record_types.add(record_type)
+			line = '\t'.join(['#type'] + [name for name, value in fields])
+			_record_stream.write('%s\n' % line)
+
+		line = '\t'.join([record_type] + [tsv_value(value) for name, value in fields])
+	else:
+		line = json.dumps(OrderedDict([('type', record_type)] + fields))
+
+	if isinstance(line, unicode):
+		line = line.encode('utf-8')
+
+	_record_stream.write('%s\n' % line)
+	_record_stream.flush()
+
+def end_output():
+	"""Writes the output collected since begin_output, through a pager if it
+	does not fit in the terminal"""
+
+	global _output_buffer, _output_stream
+
+	if _output_buffer is None:
+		return
+
+	output = _output_buffer.getvalue()
+
+	sys.stdout = _output_stream
+
+	_output_buffer = None
+	_output_stream = None
+
+	terminal = detect_terminal()
+
+	if options['pager'] and terminal['isatty'] and output.count('\n') >= terminal['rows'] > 0:
+		# The client of the gitpr server runs the pager on its terminal
+		if _server_relay is not None:
+			_server_relay.page(output)
+			return
+
+		pager = os.popen('git var GIT_PAGER').read().strip() or 'less'
+
+		env = dict(os.environ)
+		env.setdefault('LESS', 'FRX')
+
+		process = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE, env=env)
+		process.communicate(output)
+	else:
+		sys.stdout.write(output)
+		sys.stdout.flush()
+
+def fetch_pull_request(pull_request):
+	"""Fetches a pull request into a local branch, and returns the name of the
+	local branch"""
+
+	branch_name = build_branch_name(pull_request)
+
+	remote, remote_ref = get_fetch_source(pull_request)
+
+	# print json.dumps(pull_request,sort_keys=True, indent=4)
+
+	ret = os.system('git fetch %s%s %s:%s' % (get_fetch_args(remote), remote, remote_ref, branch_name))
+
+	invalidate_refs()
+
+	if ret != 0 and get_ref_sha('refs/heads/%s' % branch_name) is None:
 		raise UserWarning("Fetch failed")
 
-	try:
-		os.remove('/tmp/git-pull-request-treeish-%s' % pull_request['number'])
-	except OSError:
-		pass
+	global _fetched
+
+	_fetched = True
+
+	set_treeish(pull_request['number'], None)
 
 	return branch_name
 
+def get_commit_graph_layers():
+	"""Returns the number of commits of each layer of the commit-graph, and
+	whether the layer has changed-path Bloom filters"""
+
+	info_path = os.popen('git rev-parse --git-path objects/info').read().strip()
+	chain_path = os.path.join(info_path, 'commit-graphs', 'commit-graph-chain')
+
+	graph_paths = []
+
+	if os.path.exists(chain_path):
+		f = open(chain_path, 'rb')
+
+		for graph_hash in f.read().split():
+			graph_paths.append(os.path.join(info_path, 'commit-graphs', 'graph-%s.graph' % graph_hash))
+
+		f.close()
+	elif os.path.exists(os.path.join(info_path, 'commit-graph')):
+		graph_paths.append(os.path.join(info_path, 'commit-graph'))
+
+	layers = []
+
+	for graph_path in graph_paths:
+		f = open(graph_path, 'rb')
+
+		# See Documentation/gitformat-commit-graph.txt in git
+		header = f.read(8)
+
+		if header[0:4] != 'CGPH':
+			f.close()
+			continue
+
+		chunk_count = ord(header[6])
+		chunk_table = f.read(12 * chunk_count)
+		chunks = {}
+
+		for i in range(chunk_count):
+			chunk_id, offset = struct.unpack('>4sQ', chunk_table[i * 12:(i + 1) * 12])
+			chunks[chunk_id] = offset
+
+		commits = 0
+
+		# The last entry of the fanout table is the number of commits
+		if 'OIDF' in chunks:
+			f.seek(chunks['OIDF'] + 255 * 4)
+			commits = struct.unpack('>I', f.read(4))[0]
+
+		f.close()
+
+		layers.append({'commits': commits, 'bloom': 'BIDX' in chunks})
+
+	return layers
+
+def get_complete_aliases():
+	"""Returns the user aliases and github names for shell completion"""
+
+	users = get_users(True)
+
+	return sorted(set(users.keys()) | set(users.values()))
+
+def get_complete_branches():
+	"""Returns the local branch names for shell completion"""
+
+	return os.popen('git for-each-ref --format="%(refname:short)" refs/heads/').read().split()
+
+def get_complete_pull_request_IDs():
+	"""Returns the IDs of the cached open pull requests for shell completion,
+	refreshing the cache in the background if it is missing or old"""
+
+	load_options()
+
+	# Outside a repository there are no pull requests, nor a state dir to create
+	if _git_dir == '':
+		return []
+
+	repo_name = get_complete_repo_name()
+
+	if repo_name is None:
+		return []
+
+	pulls_cache = load_state('pulls-cache', {})
+
+	cache_ttl = int(options['complete-cache-ttl'])
+	now = time.time()
+
+	if now - pulls_cache.get('times', {}).get(repo_name, 0) > cache_ttl:
+		# A refresh that fails is retried after cache_ttl, not on every completion
+		def claim_refresh(pulls_cache):
+			refresh_times = pulls_cache.setdefault('refresh-times', {})
+
+			if now - refresh_times.get(repo_name, 0) > cache_ttl:
+				refresh_times[repo_name] = now
+
+			return pulls_cache
+
+		pulls_cache = update_state('pulls-cache', claim_refresh, {})
+
+		if pulls_cache['refresh-times'][repo_name] == now:
+			devnull = open(os.devnull, 'wb')
+			subprocess.Popen([get_script_path(), '-r', repo_name, 'complete-refresh'], stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+			devnull.close()
+
+	pull_request_IDs = pulls_cache.get('repos', {}).get(repo_name, [])
+
+	return [str(pull_request_ID) for pull_request_ID in sorted(pull_request_IDs)]
+
+def get_complete_repo_name():
+	"""Returns the github repository of the current directory as found by
+	get_default_repo_name, from the config read by load_options so that no more
+	git commands are run, or None if it cannot be determined"""
+
+	repo_name = get_git_config('github.repo')
+
+	if repo_name != '':
+		return repo_name
+
+	m = re.search("github\.com[^\n]*?[:/]([^\n]+?)\.git", get_git_config('remote.origin.url'))
+
+	if m is not None and m.group(1) != '':
+		return m.group(1)
+
 def get_current_branch_name(ensure_pull_request = True):
 	"""Returns the name of the current pull request branch"""
 	branch_name = os.popen('git rev-parse --abbrev-ref HEAD').read().strip()
@@ -740,368 +2143,1865 @@ def get_current_branch_name(ensure_pull_request = True):
 	if ensure_pull_request and branch_name[0:13] != 'pull-request-':
 		raise UserWarning("Invalid branch: not a pull request")
 
-	return branch_name
+	return branch_name
+
+def get_default_repo_name():
+	repo_name = os.popen('git config github.repo').read().strip()
+
+	# get repo name from origin
+	if repo_name is None or repo_name == '':
+		repo_name = get_repo_name_for_remote('origin')
+
+	if repo_name is None or repo_name == '':
+		raise UserWarning("Failed to determine github repository name")
+
+	return repo_name
+
+def get_diff_stats(merge_base, head):
+	"""Returns the diff stats between the two commits, reusing the cached stats
+	if they have been computed before"""
+
+	global _stats_cache
+
+	if _stats_cache is None:
+		_stats_cache = load_state('stats-cache', {})
+
+	key = '%s..%s' % (merge_base, head)
+	entry = _stats_cache.get(key)
+
+	if entry is None:
+		shortstat = os.popen('git --no-pager diff --shortstat %s' % key).read().rstrip()
+		numstat = os.popen('git --no-pager diff --numstat --no-renames %s' % key).read()
+
+		extensions = {}
+		files = []
+		insertions = 0
+		deletions = 0
+
+		for line in numstat.splitlines():
+			parts = line.split('\t', 2)
+
+			if len(parts) < 3:
+				continue
+
+			path = parts[2]
+			extension = path.rsplit('.', 1)[-1]
+
+			extensions[extension] = extensions.get(extension, 0) + 1
+			files.append(path)
+
+			if parts[0] != '-':
+				insertions += int(parts[0])
+				deletions += int(parts[1])
+
+		entry = {
+			'stats': {
+				'shortstat': shortstat,
+				'extensions': extensions,
+				'files': files,
+				'insertions': insertions,
+				'deletions': deletions
+			}
+		}
+
+		_stats_cache[key] = entry
+
+	entry['time'] = time.time()
+
+	return entry['stats']
+
+def get_display_pr_stats(pull_request, remote_repo_name = None):
+	stats = None
+
+	if remote_repo_name is not None:
+		stats = get_remote_pull_request_stats(remote_repo_name, pull_request)
+
+	if stats is None:
+		stats = get_pull_request_stats(pull_request)
+
+	return stats
+
+def get_fetch_args(remote):
+	"""Returns the extra arguments to pass to git fetch when fetching pull
+	request branches from the remote"""
+
+	fetch_args = ''
+
+	if remote == get_promisor_remote():
+		fetch_args += '--filter=%s ' % options['fetch-filter']
+
+	# In a shallow repository do not fetch the history of the fork older than
+	# the local history, which would otherwise be fetched all the way back when
+	# the pull request is based on a commit older than the shallow boundary
+	if os.popen('git rev-parse --is-shallow-repository').read().strip() == 'true':
+		shallow_path = os.popen('git rev-parse --git-path shallow').read().strip()
+
+		f = open(shallow_path, 'r')
+		shallow_commits = f.read().split()
+		f.close()
+
+		commit_times = os.popen('git log --no-walk --format=%%ct %s' % ' '.join(shallow_commits)).read().split()
+
+		if commit_times:
+			fetch_args += '--shallow-since=@%s ' % min([int(commit_time) for commit_time in commit_times])
+
+	return fetch_args
+
+def get_fetch_source(pull_request):
+	"""Returns the remote and the ref to fetch the pull request from.
+
+	With the 'fetch-filter' option, pull requests sent to the repository of the
+	promisor remote are fetched from it through the refs/pull/<ID>/head ref
+	github keeps, so that the objects filtered out are fetched from the same
+	remote later on. Other pull requests are fetched from their fork without a
+	filter, which only transfers the objects the pull request adds."""
+
+	promisor_remote = get_promisor_remote()
+
+	if promisor_remote is not None:
+		promisor_repo_name = get_repo_name_for_remote(promisor_remote)
+		base_url = pull_request['base'].get('repository', {}).get('url', '')
+
+		if promisor_repo_name and re.search("github\.com[:/]%s(\.git)?$" % re.escape(promisor_repo_name), base_url):
+			return (promisor_remote, 'refs/pull/%s/head' % pull_request['number'])
+
+	return (get_repo_url(pull_request), pull_request['head']['ref'])
+
+def get_files_signature(paths):
+	"""Returns the modification times and sizes of the files, which change
+	whenever the files are written"""
+
+	signature = []
+
+	for path in paths:
+		try:
+			info = os.stat(path)
+			signature.append((os.path.abspath(path), info.st_mtime, info.st_size))
+		except OSError:
+			signature.append((os.path.abspath(path), None, None))
+
+	return signature
+
+def get_git_config(name):
+	"""Returns the value of the git config setting as read by load_options, or
+	an empty string if it is not set"""
+
+	values = re.findall("^%s=([^\n]*)$" % re.escape(name), _git_config or '', re.MULTILINE)
+
+	if len(values) == 0:
+		return ''
+
+	return values[-1].strip()
+
+def get_git_config_signature(git_dir):
+	"""Returns the signature of the git config files read in the repository,
+	along with the environment variables overriding them"""
+
+	home = os.path.expanduser('~')
+	xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(home, '.config')
+
+	paths = ['/etc/gitconfig', os.path.join(home, '.gitconfig'), os.path.join(xdg_config_home, 'git', 'config')]
+
+	if git_dir:
+		paths.append(os.path.join(git_dir, 'config'))
+
+	environment = sorted([(key, value) for key, value in os.environ.items() if key.startswith('GIT_CONFIG')])
+
+	return [environment] + get_files_signature(paths)
+
+def get_git_base_path():
+	return os.popen('git rev-parse --show-toplevel').read().strip()
+
+def get_merge_conflicts(base, head):
+	"""Returns the files that conflict when merging the two commits, using an
+	in-memory merge that does not touch the index or the work tree"""
+
+	process = subprocess.Popen(['git', 'merge-tree', '--write-tree', '--name-only', '--no-messages', base, head], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	output, error = process.communicate()
+
+	if process.returncode not in (0, 1):
+		raise UserWarning("Could not merge %s into %s (git merge-tree --write-tree requires git 2.38 or newer)\n%s" % (head, base, error.strip()))
+
+	conflicts = []
+
+	# The first line is the merged tree, followed by the conflicted files
+	for path in output.splitlines()[1:]:
+		if path and path not in conflicts:
+			conflicts.append(path)
+
+	return conflicts
+
+def get_indexed_pull_requests(repo_name):
+	"""Returns the open pull requests that have been fetched, after bringing
+	their entries in the file index up to date"""
+
+	pull_requests = get_pull_requests(repo_name)
+
+	open_IDs = set([str(pull_request['number']) for pull_request in pull_requests])
+
+	load_file_index()
+
+	for pull_request_ID in _file_index['pulls'].keys():
+		if pull_request_ID not in open_IDs:
+			update_file_index(pull_request_ID, None, [])
+
+	if options['filter-by-update-branch']:
+		pull_requests = [pull for pull in pull_requests if pull['base']['ref'] == options['update-branch']]
+
+	indexed_pull_requests = []
+	skipped = 0
+
+	for pull_request in pull_requests:
+		if get_pull_request_stats(pull_request, False) is None:
+			skipped += 1
+		else:
+			indexed_pull_requests.append(pull_request)
+
+	save_stats_cache()
+	save_file_index()
+
+	if skipped > 0:
+		print color_text("Skipped %s pull requests that have not been fetched, run 'gitpr fetch-all' to include them" % skipped, 'warning')
+		print
+
+	return indexed_pull_requests
+
+def get_original_dir_path():
+	git_base_path = get_git_base_path()
+
+	update_progress = load_state('updates', {}).get(os.path.realpath(get_work_dir()), {})
+	original_dir_path = update_progress.get('original_dir_path')
+
+	if original_dir_path == None or original_dir_path == '':
+		config_path = os.readlink(os.path.join(git_base_path, '.git', 'config'))
+		original_dir_path = os.path.dirname(os.path.dirname(config_path))
+
+	return original_dir_path
+
+def get_reviewer_repo_name(repo_name, username, reviewer_repo_name = None):
+	"""Returns the full name of the repository to submit pull requests to"""
+
+	if reviewer_repo_name is None or reviewer_repo_name == '':
+		reviewer_repo_name = get_git_config('github.reviewer')
+
+	# Only the commands submitting pull requests load the user aliases
+	if reviewer_repo_name:
+		reviewer_repo_name = lookup_alias(reviewer_repo_name)
+
+	if reviewer_repo_name is None or reviewer_repo_name == '':
+		reviewer_repo_name = get_repo_name_for_remote('upstream')
+
+	if reviewer_repo_name is None or reviewer_repo_name == '':
+		raise UserWarning("Could not determine a repo to submit this pull request to")
+
+	if '/' not in reviewer_repo_name:
+		reviewer_repo_name = repo_name.replace(username, reviewer_repo_name)
+
+	return reviewer_repo_name
+
+def get_script_path():
+	"""Returns the path of this script, also when git-pull-request-complete.py
+	loaded it from its cached bytecode"""
+
+	return re.sub('\\.pyc$', '.py', os.path.abspath(__file__))
+
+def get_server_socket_path():
+	"""Returns the path of the Unix socket of the gitpr server of the user, in a
+	directory only the user can access"""
+
+	return os.path.join(tempfile.gettempdir(), 'git-pull-request-%s' % os.getuid(), 'server.sock')
+
+def get_state_path(name):
+	"""Returns the path of a file in the git-pull-request state directory of the
+	repository, which is shared with any work directories of the repository"""
+
+	global _state_dir
+
+	if _state_dir is None:
+		git_dir = _git_dir
+
+		if git_dir is None:
+			git_dir = os.popen('git rev-parse --git-dir').read().strip()
+
+		if git_dir == '':
+			raise UserWarning("Not a git repository")
+
+		# Work directories symlink their config to the original repository
+		config_path = os.path.realpath(os.path.join(git_dir, 'config'))
+		_state_dir = os.path.join(os.path.dirname(config_path), 'git-pull-request')
+
+		if not os.path.isdir(_state_dir):
+			os.makedirs(_state_dir)
+
+	return os.path.join(_state_dir, name)
+
+def get_users(quiet = False):
+	"""Returns the user aliases (and email names) mapped to github names. They
+	are only loaded from the aliases file and its journal the first time they
+	are needed, and again once the files change."""
+
+	global _users, _users_by_login, _users_signature
+
+	users_alias_file = get_users_alias_file()
+
+	# Kept by the gitpr server until the aliases file or its journal change
+	signature = get_files_signature([users_alias_file, '%s.journal' % users_alias_file])
+
+	if _users is not None and _users_signature == signature:
+		return _users
+
+	_users = {}
+	_users_by_login = {}
+	_users_signature = signature
+
+	try:
+		github_users_file = open(users_alias_file, 'r')
+	except IOError:
+		if not quiet:
+			print "File %s could not be found. Using email names will not be available. Run the update-users command to enable this funcionality" % users_alias_file
+
+		github_users_file = None
+
+	if github_users_file is not None:
+		try:
+			github_users = json.load(github_users_file)
+		except ValueError:
+			github_users = {}
+
+		github_users_file.close()
+
+		for alias, githubname in github_users.iteritems():
+			set_user_alias(alias, githubname)
+
+	# Aliases created since the file was last written
+	try:
+		journal_file = open('%s.journal' % users_alias_file, 'r')
+	except IOError:
+		journal_file = None
+
+	if journal_file is not None:
+		for line in journal_file:
+			try:
+				alias, githubname = json.loads(line)
+			except ValueError:
+				continue
+
+			set_user_alias(alias, githubname)
+
+		journal_file.close()
+
+	return _users
+
+def get_users_alias_file():
+	global _users_alias_file
+
+	if _users_alias_file is None:
+		_users_alias_file = os.popen('git config git-pull-request.users-alias-file').read().strip()
+
+		if len(_users_alias_file) == 0:
+			_users_alias_file = "git-pull-request.users"
+
+	return _users_alias_file
+
+def get_work_dir():
+	global _work_dir
+
+	if (_work_dir == None):
+		symbolic_ref = os.popen('git symbolic-ref HEAD').read().strip().replace('refs/heads/', '')
+		work_dir_global = options['work-dir']
+
+		work_dir_option = None
+
+		if symbolic_ref:
+			work_dir_option = 'work-dir-%s' % symbolic_ref
+
+		if work_dir_option:
+			_work_dir = os.popen('git config git-pull-request.%s' % work_dir_option).read().strip()
+			options[work_dir_option] = _work_dir
+
+		if not os.path.exists(_work_dir):
+			_work_dir = False
+
+		if not _work_dir:
+			if work_dir_global and os.path.exists(work_dir_global):
+				_work_dir = work_dir_global
+			else:
+				_work_dir = False
+
+	return _work_dir
+
+def get_overlapping_pull_requests(pull_request_ID, pull_request_IDs):
+	"""Returns the pull requests among pull_request_IDs that change any of the
+	files changed by the pull request, mapped to the shared files"""
+
+	load_file_index()
+
+	entry = _file_index['pulls'].get(str(pull_request_ID))
+	overlaps = {}
+
+	if entry is None:
+		return overlaps
+
+	for path in entry['files']:
+		for overlap_ID in _file_index['files'].get(path, []):
+			if overlap_ID != pull_request_ID and overlap_ID in pull_request_IDs:
+				overlaps.setdefault(overlap_ID, []).append(path)
+
+	return overlaps
+
+def get_promisor_remote():
+	"""Returns the remote of the partial clone to fetch pull requests from with
+	the 'fetch-filter' option, or None if the option is not set"""
+
+	if not options['fetch-filter']:
+		return None
+
+	promisor_remote = os.popen('git config extensions.partialclone').read().strip()
+
+	# Newer versions of git mark the remote itself instead
+	if promisor_remote == '':
+		m = re.search("^remote\.(.+)\.promisor true$", os.popen("git config --bool --get-regexp '^remote\..*\.promisor$'").read(), re.MULTILINE)
+
+		if m is not None:
+			promisor_remote = m.group(1)
+
+	if promisor_remote == '':
+		raise UserWarning("Fetching with the '%s' filter requires a partial clone (git clone --filter=%s)" % (options['fetch-filter'], options['fetch-filter']))
+
+	return promisor_remote
+
+def get_pull_request(repo_name, pull_request_ID):
+	"""Returns information retrieved from github about the pull request"""
+
+	url = "http://github.com/api/v2/json/pulls/%s/%s" % (repo_name, pull_request_ID)
+	data = github_json_request(url)
+
+	return data['pull']
+
+def get_pull_request_stats(pull_request, fetch = True):
+	"""Returns the diff stats of a pull request against the update-branch,
+	fetching it first if needed. Returns None if the pull request has not been
+	fetched and fetch is False."""
+
+	branch_name = build_branch_name(pull_request)
+	head = get_ref_sha('refs/heads/%s' % branch_name)
+
+	if head is None:
+		if not fetch:
+			return None
+
+		branch_name = fetch_pull_request(pull_request)
+
+		head = get_ref_sha('refs/heads/%s' % branch_name)
+
+		if head is None:
+			raise UserWarning("Fetch failed")
+
+	merge_base = os.popen('git merge-base %s %s' % (options['update-branch'], head)).read().strip()
+
+	stats = get_diff_stats(merge_base, head)
+
+	update_file_index(pull_request['number'], '%s..%s' % (merge_base, head), stats['files'])
+
+	return stats
+
+def get_pull_requests(repo_name, filter_by_update_branch=False):
+	"""Returns information retrieved from github about the open pull requests on
+	the repository"""
+
+	data = github_json_request(get_pull_requests_url(repo_name))
+	pulls = data['pulls']
+
+	update_pulls_cache(repo_name, pulls)
+
+	if filter_by_update_branch:
+		update_branch = options['update-branch']
+
+		pull_requests = [pull for pull in pulls if pull['base']['ref'] == update_branch]
+	else:
+		pull_requests = pulls
+
+	return pull_requests
+
+def get_pull_request_labels(pull_request):
+	"""Returns the names of the labels of the pull request"""
+
+	labels = []
+
+	for label in pull_request.get('labels') or []:
+		if isinstance(label, dict):
+			label = label.get('name')
+
+		labels.append(label)
+
+	return labels
+
+def get_pull_requests_url(repo_name):
+	return "http://github.com/api/v2/json/pulls/%s/open" % repo_name
+
+def get_pull_request_age(pull_request, field = 'created_at'):
+	"""Returns the number of days since the date in the field of the pull
+	request"""
+
+	m = re.search("(\d{4})\D(\d{2})\D(\d{2})", pull_request.get(field) or '')
+
+	if m is None:
+		return 0
+
+	return (date.today() - date(int(m.group(1)), int(m.group(2)), int(m.group(3)))).days
+
+def get_pull_request_fields(pull_request):
+	"""Returns the fields of the record of a pull request for the 'format'
+	option"""
+
+	return [
+		('number', pull_request.get('number')),
+		('title', pull_request.get('title')),
+		('user', pull_request['user'].get('login')),
+		('name', pull_request['user'].get('name')),
+		('base', pull_request['base']['ref']),
+		('head', pull_request['head']['ref']),
+		('url', pull_request.get('html_url'))
+	]
+
+def get_pull_request_ID(branch_name):
+	"""Returns the pull request number of the branch with the name, or None if it
+	is not a pull request branch"""
+
+	m = re.search("^pull-request-(\d+)", branch_name)
+
+	if m is None:
+		return None
+
+	return int(m.group(1))
+
+def get_ref_sha(ref_name):
+	"""Returns the SHA the fully qualified ref points to, or None if the ref
+	does not exist. All the refs are read at once with a single for-each-ref, so
+	looking up the branches of many pull requests does not spawn a process for
+	each of them."""
+
+	return load_refs().get(ref_name)
+
+def get_refs(prefix):
+	"""Returns the names of the refs starting with the prefix"""
+
+	return sorted([ref for ref in load_refs() if ref.startswith(prefix)])
+
+def get_remote_pull_request_files(repo_name, pull_request):
+	"""Returns the files changed by a pull request as listed by the github API,
+	or None if it changes more files than the API lists or they could not be
+	loaded, so that the stats are computed locally instead"""
+
+	url = "https://api.github.com/repos/%s/pulls/%s/files?per_page=100&page=%%s" % (repo_name, pull_request['number'])
+
+	# The API lists at most 3000 files, 100 per page
+	page_count = 30
+	changed_files = pull_request.get('changed_files')
+
+	if changed_files is not None:
+		if changed_files >= 3000:
+			return None
+
+		page_count = changed_files / 100 + 1
+
+	# Pull requests whose files cannot be listed, for example because of the
+	# rate limit, are diffed locally instead
+	try:
+		if changed_files is not None:
+			pages = run_parallel(lambda page: github_json_request(url % page), range(1, page_count + 1))
+		else:
+			pages = []
+
+			for page in range(1, page_count + 1):
+				pages.append(github_json_request(url % page))
+
+				if len(pages[-1]) < 100:
+					break
+	except UserWarning:
+		return None
+
+	pull_request_files = []
+
+	for page in pages:
+		pull_request_files.extend(page)
+
+	if len(pull_request_files) >= 3000:
+		return None
+
+	return pull_request_files
+
+def get_remote_pull_request_stats(repo_name, pull_request, pull_request_files = None):
+	"""Returns the diff stats of a pull request computed from the files listed by
+	the github API (loaded unless given), without fetching it. Returns None if
+	the pull request changes more files than the API lists, or they could not
+	be loaded."""
+
+	global _stats_cache
+
+	if _stats_cache is None:
+		_stats_cache = load_state('stats-cache', {})
+
+	key = 'remote:%s..%s' % (pull_request['base']['sha'], pull_request['head']['sha'])
+
+	if key in _stats_cache:
+		_stats_cache[key]['time'] = time.time()
+
+		return _stats_cache[key]['stats']
+
+	# Not loaded again for every use once it failed
+	if key in _remote_stats_unavailable:
+		return None
+
+	if pull_request_files is None:
+		pull_request_files = get_remote_pull_request_files(repo_name, pull_request)
+
+	if pull_request_files is None:
+		_remote_stats_unavailable.add(key)
+
+		return None
+
+	extensions = {}
+	files = []
+	insertions = 0
+	deletions = 0
+
+	for pull_request_file in pull_request_files:
+		path = pull_request_file['filename']
+		extension = path.rsplit('.', 1)[-1]
+
+		extensions[extension] = extensions.get(extension, 0) + 1
+		files.append(path)
+
+		insertions += pull_request_file.get('additions', 0)
+		deletions += pull_request_file.get('deletions', 0)
+
+	# Same as git diff --shortstat
+	shortstat = " %d file%s changed" % (len(files), len(files) != 1 and 's' or '')
+
+	if insertions or not deletions:
+		shortstat += ", %d insertion%s(+)" % (insertions, insertions != 1 and 's' or '')
+
+	if deletions or not insertions:
+		shortstat += ", %d deletion%s(-)" % (deletions, deletions != 1 and 's' or '')
+
+	stats = {
+		'shortstat': shortstat,
+		'extensions': extensions,
+		'files': files,
+		'insertions': insertions,
+		'deletions': deletions
+	}
+
+	_stats_cache[key] = {'stats': stats, 'time': time.time()}
+
+	update_file_index(pull_request['number'], key, files)
+
+	return stats
+
+def get_repo_name_for_remote(remote_name):
+	"""Returns the repository name for the remote with the name"""
+
+	remotes = os.popen('git remote -v').read()
+	m = re.search("^%s[^\n]+?github\.com[^\n]*?[:/]([^\n]+?)\.git" % remote_name, remotes, re.MULTILINE)
+
+	if m is not None and m.group(1) != '':
+		return m.group(1)
+
+def get_repo_url(pull_request):
+	"""Returns the git URL of the repository the pull request originated from"""
+
+	repo_url = pull_request['head']['repository']['url'].replace('https', 'git')
+	private_repo = pull_request['head']['repository']['private']
+
+	if private_repo:
+		repo_url = repo_url.replace('git://github.com/', 'git@github.com:')
+
+	return repo_url
+
+def github_json_request(url, params = None, authenticate = True):
+	global _rate_limit_remaining
+
+	if params is None and url in _responses:
+		response_time, data = _responses[url]
+
+		if time.time() - response_time < int(options['response-cache-ttl']):
+			return data
+
+	if params is not None:
+		data = urllib.urlencode(params)
+		req = urllib2.Request(url, data)
+	else:
+		req = urllib2.Request(url)
+
+	if authenticate:
+		authorize_request(req)
+
+	# Shared by the processes of the repositories of the --repos option
+	if _rate_limit_shared is not None and _rate_limit_shared.value >= 0:
+		_rate_limit_remaining = _rate_limit_shared.value
+
+	if _rate_limit_remaining == 0:
+		raise UserWarning("The github API rate limit has been reached, try again later")
+
+	print url
+
+	try:
+		response = urllib2.urlopen(req)
+	except urllib2.URLError, msg:
+		raise UserWarning("Error communicating with github: \n%s\n%s" % (url, msg))
+
+	rate_limit_remaining = response.info().getheader('X-RateLimit-Remaining')
+
+	if rate_limit_remaining is not None:
+		_rate_limit_remaining = int(rate_limit_remaining)
+
+		if _rate_limit_shared is not None:
+			_rate_limit_shared.value = _rate_limit_remaining
+
+	data = response.read()
+	if data == '':
+		raise UserWarning("Invalid response from github")
+
+	data = json.loads(data)
+	# print json.dumps(data,sort_keys=True, indent=4)
+
+	if params is None:
+		_responses[url] = (time.time(), data)
+	else:
+		# The change makes the previous responses stale
+		_responses.clear()
+
+	return data
+
+def import_modules():
+	"""Imports the modules that shell completion does not need, which take most
+	of the time of starting up"""
+
+	global base64, multiprocessing, select, socket, threading, traceback, urllib, urllib2, ThreadPool
+
+	import base64
+	import multiprocessing
+	import select
+	import socket
+	import threading
+	import traceback
+	import urllib
+	import urllib2
+
+	from multiprocessing.pool import ThreadPool
+
+def in_work_dir():
+	git_base_path = get_git_base_path()
+
+	work_dir = get_work_dir()
+
+	return git_base_path == work_dir and os.path.islink(os.path.join(git_base_path, '.git', 'config'))
+
+def load_options():
+	global _git_config, _git_dir
+
+	git_paths = os.popen('git rev-parse --git-dir --show-toplevel').read().splitlines()
+
+	git_dir = ''
+	git_base_path = ''
+
+	if len(git_paths) > 0:
+		git_dir = os.path.abspath(git_paths[0])
+
+	if len(git_paths) > 1:
+		git_base_path = git_paths[1]
+
+	# Saves get_state_path another git command
+	_git_dir = git_dir
+
+	# The gitpr server keeps the config of each repository until it changes
+	signature = get_git_config_signature(git_dir)
+	cached_config = _git_configs.get(git_dir)
+
+	if cached_config is not None and cached_config[0] == signature:
+		all_config = cached_config[1]
+	else:
+		all_config = os.popen('git config -l').read().strip()
+		_git_configs[git_dir] = (signature, all_config)
+
+	_git_config = all_config
+
+	path_prefix = "%s." % git_base_path
+
+	overrides = {}
+
+	matches = re.findall("^git-pull-request\.([^=]+)=([^\n]*)$", all_config, re.MULTILINE)
+
+	for k in matches:
+		key = k[0]
+		value = k[1]
+
+		if value.lower() in ('f', 'false', 'no'):
+			value = False
+		elif value.lower() in ('t', 'true', 'yes'):
+			value = True
+		elif value.lower() in ('', 'none', 'null', 'nil'):
+			value = None
+
+		if key.find(path_prefix) == -1:
+			options[key] = value
+		else:
+			key = key.replace(path_prefix, '')
+			overrides[key] = value
+
+	options.update(overrides)
+
+def main():
+	# shell completion has to be fast, so it skips the rest of the startup
+	if len(sys.argv) > 1 and sys.argv[1] == 'complete':
+		command_complete(sys.argv[2:])
+		return
+
+	# neither does rendering diffs in the background need github
+	if len(sys.argv) > 2 and sys.argv[1] == 'render-diffs':
+		command_render_diffs(sys.argv[2], sys.argv[3:])
+		return
+
+	import_modules()
+
+	# parse command line options
+	try:
+		opts, args = getopt.gnu_getopt(sys.argv[1:], 'hqar:u:l:b:', ['help', 'quiet', 'all', 'repo=', 'reviewer=', 'update', 'no-update', 'user=', 'update-branch=', 'filter=', 'origin', 'dry-run', 'repos=', 'stale-days=', 'label=', 'format=', 'branches', 'pattern=', 'remote', 'restart'])
+	except getopt.GetoptError, e:
+		raise UserWarning("%s\nFor help use --help" % e)
+
+	if len(args) > 0 and args[0] == 'help':
+		command_help()
+		sys.exit(0)
+
+	# The gitpr server has no terminal for the editor or credential prompts
+	if _server_relay is not None and needs_terminal(opts, args):
+		_server_relay.local = True
+		return
+
+	default_options = dict(options)
+
+	# load git options
+	load_options()
+
+	global auth_string, auth_token, _record_stream
+	global _work_dir
+
+	_work_dir = None
+
+	repo_name = None
+	reviewer_repo_name = None
+
+	username = get_git_config('github.user')
+	auth_token = get_git_config('github.token')
+
+	if _server_relay is not None and (len(username) == 0 or len(auth_token) == 0):
+		raise UserWarning("Run gitpr once without the server to set up your github credentials")
+
+	if len(username) == 0:
+		username = raw_input("Github username: ").strip()
+		os.system("git config --global github.user %s" % username)
+
+	if len(auth_token) == 0:
+		print "Please go to https://github.com/account/admin to find your API token"
+		auth_token = raw_input("Github API token: ").strip()
+		os.system("git config --global github.token %s" % auth_token)
+
+	auth_user = "%s/token" % username
+	auth_string = base64.encodestring('%s:%s' % (auth_user, auth_token)).replace('\n', '')
+
+	fetch_auto_update = options['fetch-auto-update']
+	prune_origin = False
+	dry_run = False
+	repo_paths = []
+	option_overrides = {}
+	stale_days = None
+	label = None
+	submit_branches = False
+	submit_pattern = None
+	remote_stats = False
+	restart = False
+
+	info_user = username
+	submitOpenGitHub = options['submit-open-github']
+
+	# process options
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			command_help()
+			sys.exit(0)
+		elif o in ('-l', '--user'):
+			info_user = lookup_alias(a)
+		elif o in ('-q', '--quiet'):
+			submitOpenGitHub = False
+		elif o in ('-a', '--all'):
+			option_overrides['filter-by-update-branch'] = False
+		elif o in ('-r', '--repo'):
+			if re.search('/', a):
+				repo_name = a
+			else:
+				repo_name = get_repo_name_for_remote(a)
+		elif o in ('-b', '--update-branch'):
+			option_overrides['update-branch'] = a
+		elif o in ('-u', '--reviewer'):
+			reviewer_repo_name = a
+		elif o == '--update':
+			fetch_auto_update = True
+		elif o == '--no-update':
+			fetch_auto_update = False
+		elif o == '--filter':
+			option_overrides['fetch-filter'] = a
+		elif o == '--origin':
+			prune_origin = True
+		elif o == '--dry-run':
+			dry_run = True
+		elif o == '--remote':
+			remote_stats = True
+		elif o == '--restart':
+			restart = True
+		elif o == '--branches':
+			submit_branches = True
+		elif o == '--pattern':
+			submit_pattern = a
+		elif o == '--format':
+			option_overrides['format'] = a
+		elif o == '--stale-days':
+			try:
+				stale_days = int(a)
+			except ValueError:
+				raise UserWarning("Invalid number of days: %s" % a)
+		elif o == '--label':
+			label = a
+		elif o == '--repos':
+			for pattern in a.split(','):
+				repo_paths.extend([os.path.abspath(path) for path in sorted(glob.glob(os.path.expanduser(pattern.strip())))])
+
+			if not repo_paths:
+				raise UserWarning("No repositories match %s" % a)
+
+	options.update(option_overrides)
+
+	if options['format'] not in ('text', 'jsonl', 'tsv'):
+		raise UserWarning("Invalid format: %s" % options['format'])
+
+	# Records go to stdout, everything else to stderr
+	if options['format'] != 'text':
+		_record_stream = sys.stdout
+		sys.stdout = sys.stderr
+
+	if repo_paths:
+		command_repos(repo_paths, args, default_options, option_overrides, remote_stats, restart)
+		return
+
+	# get repo name from git config
+	if repo_name is None or repo_name == '':
+		repo_name = get_default_repo_name()
+
+	# process arguments
+	if len(args) > 0:
+		if args[0] == 'alias':
+			if len(args) >= 2:
+				command_alias(args[1], args[2])
+		elif args[0] == 'check':
+			if len(args) >= 2:
+				command_check(repo_name, args[1])
+			else:
+				command_check(repo_name)
+		elif args[0] == 'close':
+			pull_request_IDs = [int(arg) for arg in args[1:] if arg.isdigit()]
+			comments = [arg for arg in args[1:] if not arg.isdigit()]
+
+			comment = None
+
+			if len(comments) > 0:
+				comment = comments[0]
+
+			if pull_request_IDs or stale_days is not None or label is not None:
+				command_close_all(repo_name, pull_request_IDs, stale_days, label, comment, dry_run)
+			elif dry_run:
+				raise UserWarning("--dry-run only applies to closing pull requests by ID, --stale-days or --label")
+			else:
+				command_close(repo_name, comment)
+		elif args[0] == 'complete-refresh':
+			get_pull_requests(repo_name)
+		elif args[0] == 'commit-graph':
+			command_commit_graph()
+		elif args[0] in ('continue-update', 'cu'):
+			command_continue_update()
+		elif args[0] == 'diff':
+			if len(args) >= 2:
+				command_diff(args[1])
+			else:
+				command_diff()
+		elif args[0] == 'fetch':
+			command_fetch(repo_name, args[1], fetch_auto_update)
+		elif args[0] == 'fetch-all':
+			command_fetch_all(repo_name, restart)
+		elif args[0] == 'gc':
+			command_gc(repo_name, prune_origin, dry_run)
+		elif args[0] == 'help':
+			command_help()
+		elif args[0] == 'info':
+			command_info(info_user)
+		elif args[0] == 'info-detailed':
+			command_info(info_user, True)
+		elif args[0] == 'merge':
+			if len(args) >= 2:
+				command_merge(repo_name, args[1])
+			else:
+				command_merge(repo_name)
+		elif args[0] == 'merge-order':
+			command_merge_order(repo_name)
+		elif args[0] == 'open':
+			if len(args) >= 2:
+				command_open(repo_name, args[1])
+			else:
+				command_open(repo_name)
+		elif args[0] == 'overlap':
+			if len(args) >= 2:
+				command_overlap(repo_name, args[1])
+			else:
+				command_overlap(repo_name)
+		elif args[0] == 'pull':
+			command_pull(repo_name)
+		elif args[0] == 'report':
+			command_report(repo_name, remote_stats)
+		elif args[0] == 'server':
+			if len(args) >= 2:
+				command_server(args[1], default_options)
+			else:
+				command_server('status', default_options)
+		elif args[0] == 'submit' and (submit_branches or submit_pattern is not None):
+			branch_names = []
+			pull_body = None
+
+			# Without --branches the argument is the body of the pull requests
+			if submit_branches:
+				branch_names = args[1:]
+			elif len(args) >= 2:
+				pull_body = args[1]
+
+			command_submit_all(repo_name, username, reviewer_repo_name, branch_names, submit_pattern, pull_body)
+		elif args[0] == 'submit':
+			pull_body = None
+			pull_title = None
+
+			if len(args) >= 2:
+				pull_body = args[1]
+
+			if len(args) >= 3:
+				pull_title = args[2]
+
+			command_submit(repo_name, username, reviewer_repo_name, pull_body, pull_title, submitOpenGitHub)
+		elif args[0] == 'update':
+			if len(args) >= 2:
+					command_update(repo_name, args[1])
+			else:
+				command_update(repo_name, update_branch_option)
+		elif args[0] == 'update-users':
+			command_update_users()
+		elif args[0] == 'show-alias':
+			if len(args) >= 2:
+				command_show_alias(args[1])
+		elif args[0] == 'stats' or args[0] == 'stat':
+			pull_request_ID = None
+
+			if len(args) >= 2:
+				pull_request_ID = args[1]
+
+			get_pr_stats(repo_name, pull_request_ID, remote_stats, restart)
+		else:
+			command_fetch(repo_name, args[0], fetch_auto_update)
+	else:
+		command_show(repo_name)
+
+	maintain_commit_graph()
+
+def load_file_index():
+	"""Loads the index of the files changed by each pull request, along with the
+	inverted index from each file to the pull requests changing it"""
+
+	global _file_index
+
+	if _file_index is None:
+		_file_index = load_state('file-index', {'pulls': {}, 'files': {}})
+
+def load_refs():
+	"""Returns all the refs mapped to their SHAs, read with a single for-each-ref
+	and kept until invalidate_refs is called"""
+
+	global _refs
+
+	if _refs is None:
+		_refs = {}
+
+		for line in os.popen("git for-each-ref --format='%(objectname) %(refname)'").read().splitlines():
+			sha, ref = line.split(' ', 1)
+			_refs[ref] = sha
+
+	return _refs
+
+def load_state(name, default = None):
+	"""Returns the JSON data stored in the state file with the name"""
+
+	try:
+		f = open(get_state_path(name), 'rb')
+	except IOError:
+		return default
+
+	try:
+		data = json.load(f)
+	except ValueError:
+		data = default
+
+	f.close()
+
+	return data
+
+def invalidate_refs():
+	"""Discards the refs read by get_ref_sha and rev_parse, to be called after
+	refs are changed"""
+
+	global _cat_file, _refs
+
+	_refs = None
+
+	if _cat_file is not None:
+		_cat_file.stdin.close()
+		_cat_file.wait()
+		_cat_file = None
+
+def load_remote_pull_request_stats(repo_name, pull_requests):
+	"""Loads the changed files of the pull requests whose stats are not cached
+	from github up front, in parallel, and computes their stats from them"""
+
+	global _stats_cache
+
+	if _stats_cache is None:
+		_stats_cache = load_state('stats-cache', {})
+
+	get_key = lambda pull_request: 'remote:%s..%s' % (pull_request['base']['sha'], pull_request['head']['sha'])
+
+	uncached_pull_requests = [pull_request for pull_request in pull_requests if get_key(pull_request) not in _stats_cache]
+
+	results = run_parallel(lambda pull_request: get_remote_pull_request_files(repo_name, pull_request), uncached_pull_requests)
+
+	# The stats cache and file index are only updated from this thread
+	for pull_request, pull_request_files in zip(uncached_pull_requests, results):
+		if pull_request_files is None:
+			_remote_stats_unavailable.add(get_key(pull_request))
+		else:
+			get_remote_pull_request_stats(repo_name, pull_request, pull_request_files)
+
+def lock_path(path):
+	"""Returns an open lock file holding an exclusive lock for the file at the
+	path. The lock is released by closing the returned file."""
+
+	lock_file = open('%s.lock' % path, 'ab')
+	fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+	return lock_file
+
+def lookup_alias(key):
+	return get_users().get(key) or key
+
+def maintain_commit_graph():
+	"""Adds the commits fetched by the command to the commit-graph, in the
+	background"""
+
+	global _fetched
+
+	if _fetched and options['commit-graph']:
+		update_commit_graph(True)
+
+	_fetched = False
+
+def needs_terminal(opts, args):
+	"""Returns whether the command may need the terminal, to edit a commit
+	message or to ask for the credentials of a push or pull"""
+
+	if len(args) == 0:
+		return False
+
+	if args[0] in ('continue-update', 'cu', 'merge', 'pull', 'submit'):
+		return True
+
+	return args[0] == 'gc' and ('--origin', '') in opts
+
+def open_URL(url):
+	if (os.popen('command -v open').read().strip() != ''):
+		ret = os.system('open -g "%s" 2>/dev/null' % url)
+
+		if ret != 0:
+			os.system('open "%s"' % url)
+
+	elif (os.popen('command -v cygstart').read().strip() != ''):
+		os.system('cygstart "%s"' % url)
+
+def post_comment(repo_name, pull_request_ID, comment):
+	url = "http://github.com/api/v2/json/issues/comment/%s/%s" % (repo_name, pull_request_ID)
+	params = {'comment': comment}
+	github_json_request(url, params)
+
+def request_server(socket_path, control):
+	"""Sends the control request ('status' or 'stop') to the gitpr server, and
+	returns its status or None if it is not running"""
+
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+	try:
+		connection.connect(socket_path)
+
+		# Wait for the server to be ready, after the command it is running
+		if connection.recv(5) == '':
+			return None
+
+		connection.sendall('%s\n' % json.dumps({'control': control}))
+
+		return json.loads(connection.makefile('rb').readline())
+	except (socket.error, ValueError):
+		return None
+	finally:
+		connection.close()
+
+def remove_rendered_diffs(pull_request_ID):
+	"""Removes the review diffs rendered for the pull request"""
+
+	for diff_path in glob.glob(get_state_path(os.path.join('diffs', '%s.*' % pull_request_ID))):
+		os.remove(diff_path)
+
+def render_diff(branch_name):
+	"""Returns the review diff of the pull request branch against the
+	update-branch: its commits, the diff stat and the diff with renames and
+	copies detected. The result is cached by merge-base and head commit, and
+	rendered again once the branch moves."""
+
+	head = get_ref_sha('refs/heads/%s' % branch_name)
+
+	if head is None:
+		raise UserWarning("Could not find the branch %s" % branch_name)
+
+	merge_base = os.popen('git merge-base %s %s' % (options['update-branch'], head)).read().strip()
+
+	if merge_base == '':
+		raise UserWarning("%s has no common history with %s" % (branch_name, options['update-branch']))
+
+	pull_request_ID = get_pull_request_ID(branch_name)
+	diff_path = get_state_path(os.path.join('diffs', '%s.%s.%s' % (pull_request_ID, merge_base, head)))
+
+	if os.path.exists(diff_path):
+		f = open(diff_path, 'rb')
+		diff = f.read()
+		f.close()
+
+		return diff
+
+	diff = os.popen("git --no-pager log --color=always --format='%%C(yellow)%%h%%Creset %%s %%C(blue)(%%an)%%Creset' %s..%s" % (merge_base, head)).read()
+	diff += '\n'
+	diff += os.popen('git --no-pager diff --color=always -M -C --stat %s %s' % (merge_base, head)).read()
+	diff += '\n'
+	diff += os.popen('git --no-pager diff --color=always -M -C %s %s' % (merge_base, head)).read()
+
+	diffs_dir = os.path.dirname(diff_path)
+
+	if not os.path.isdir(diffs_dir):
+		os.makedirs(diffs_dir)
+
+	# Drop the diffs rendered before the branch moved
+	remove_rendered_diffs(pull_request_ID)
+
+	fd, temp_path = tempfile.mkstemp(prefix='.', dir=diffs_dir)
+
+	f = os.fdopen(fd, 'wb')
+	f.write(diff)
+	f.close()
+
+	os.rename(temp_path, diff_path)
+
+	return diff
+
+def render_diffs_in_background(branch_names):
+	"""Renders the review diffs of the pull request branches in a background
+	process, so that the diff command can show them right away"""
+
+	if not options['fetch-render-diffs'] or len(branch_names) == 0:
+		return
+
+	devnull = open(os.devnull, 'wb')
+	subprocess.Popen([get_script_path(), 'render-diffs', options['update-branch']] + branch_names, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+	devnull.close()
+
+def reset_repo_state():
+	"""Discards the cached state of the repository, to be called before working
+	on another repository"""
+
+	global _file_index, _git_dir, _state_dir, _stats_cache, _users_alias_file, _work_dir
+
+	invalidate_refs()
+
+	_color_codes.clear()
+	_file_index = None
+	_file_index_changes.clear()
+	_git_dir = None
+	_remote_stats_unavailable.clear()
+	_state_dir = None
+	_stats_cache = None
+	_users_alias_file = None
+	_work_dir = None
+
+def rev_parse(rev):
+	"""Returns the SHA of the commit or object the revision points to, or None if
+	it cannot be resolved. Revisions are resolved by a single long-lived
+	git cat-file --batch-check process."""
+
+	global _cat_file
+
+	if _cat_file is None:
+		_cat_file = subprocess.Popen(['git', 'cat-file', '--batch-check'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+	_cat_file.stdin.write('%s\n' % rev)
+	_cat_file.stdin.flush()
+
+	result = _cat_file.stdout.readline().split()
+
+	if len(result) != 3:
+		return None
+
+	return result[0]
+
+def run_repo_command(repo_command):
+	"""Runs a command in one of the repositories of the --repos option, and
+	returns its output and records along with the number of open pull
+	requests"""
+
+	global _record_list, _server_relay
+
+	repo_path, repo_name, repo_options, args, remote, restart = repo_command
+
+	os.chdir(repo_path)
+	reset_repo_state()
+
+	options.clear()
+	options.update(repo_options)
+
+	# The output is captured and displayed by the parent process, never paged
+	options['pager'] = False
+	_server_relay = None
+
+	sys.stdout.flush()
+	sys.stderr.flush()
+
+	output_file = tempfile.TemporaryFile()
+	saved_stdout = os.dup(1)
+	saved_stderr = os.dup(2)
+
+	os.dup2(output_file.fileno(), 1)
+	os.dup2(output_file.fileno(), 2)
+
+	if _record_stream is not None:
+		_record_list = []
+
+	error = None
+	pull_request_count = 0
+
+	try:
+		if len(args) == 0:
+			command_show(repo_name)
+		elif args[0] == 'fetch-all':
+			command_fetch_all(repo_name, restart)
+		else:
+			get_pr_stats(repo_name, None, remote, restart)
+
+		maintain_commit_graph()
+
+		pull_request_count = len(get_pull_requests(repo_name, options['filter-by-update-branch']))
+	except UserWarning, e:
+		error = str(e)
+		print color_text(e, 'error')
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+
+		os.dup2(saved_stdout, 1)
+		os.dup2(saved_stderr, 2)
+		os.close(saved_stdout)
+		os.close(saved_stderr)
+
+	output_file.seek(0)
+	output = output_file.read()
+	output_file.close()
+
+	records = _record_list or []
+	_record_list = None
+
+	reset_repo_state()
+
+	return (output, records, pull_request_count, error)
+
+def run_batch(command, repo_name, pull_requests, function, restart = False, done_function = None):
+	"""Calls the function for each of the pull requests, recording the progress
+	in a journal so that running the command again resumes where it stopped.
+	The pull requests already done are skipped, or passed to done_function if
+	given. Pull requests that fail are reported at the end instead of stopping
+	the command, and returned along with their errors."""
+
+	journal_key = '%s %s %s' % (command, repo_name, options['update-branch'])
+
+	if restart:
+		set_batch_progress(journal_key, None)
+
+	journal = load_state('batch-journal', {}).get(journal_key, {})
+
+	done_IDs = set()
+
+	for pull_request in pull_requests:
+		progress = journal.get(str(pull_request['number']))
+
+		# Pull requests updated since they were done are done again
+		if progress is not None and progress['status'] == 'done' and progress['head'] == pull_request['head'].get('sha'):
+			done_IDs.add(pull_request['number'])
+
+	if done_IDs and done_function is None:
+		print color_text("Resuming the previous run, skipping %s of %s pull requests already done (use --restart to start over)" % (len(done_IDs), len(pull_requests)), 'status')
+		print
+	elif done_IDs:
+		print color_text("Resuming the previous run, %s of %s pull requests already done (use --restart to start over)" % (len(done_IDs), len(pull_requests)), 'status')
+		print
+
+	failures = []
+
+	for pull_request in pull_requests:
+		batch_function = function
+
+		if pull_request['number'] in done_IDs:
+			if done_function is None:
+				continue
+
+			# Fails like the others, for example when its cached results are gone
+			batch_function = done_function
+
+		# The journal keeps the progress, running the command again resumes it
+		check_interrupted()
+
+		progress = {'status': 'done', 'head': pull_request['head'].get('sha')}
+
+		try:
+			batch_function(pull_request)
+		except UserWarning, e:
+			print color_text("REQUEST %s failed: %s" % (pull_request['number'], e), 'error')
+			print
+
+			progress['status'] = 'failed'
+			progress['error'] = str(e)
+
+			failures.append((pull_request, str(e)))
+
+		set_batch_progress(journal_key, pull_request['number'], progress)
+
+	if failures:
+		print color_text("Failed pull requests:", 'error')
+
+		for pull_request, error in failures:
+			print "	REQUEST %s: %s" % (pull_request['number'], error)
+
+		print
+	else:
+		set_batch_progress(journal_key, None)
+
+	return failures
+
+def run_parallel(function, items):
+	"""Calls the function for each of the items using up to 'parallel-jobs'
+	threads, and returns the results in the order of the items"""
+
+	if len(items) == 0:
+		return []
+
+	pool = ThreadPool(min(int(options['parallel-jobs']), len(items)))
+
+	try:
+		return pool.map(function, items)
+	finally:
+		pool.close()
+
+def save_state(name, data):
+	"""Stores the data as JSON in the state file with the name. The file is
+	replaced atomically, so concurrent readers never see a partial write."""
+
+	write_json_file(get_state_path(name), data)
+
+def save_file_index():
+	"""Writes the pull requests updated in the file index back to disk, keeping
+	the ones indexed by concurrent runs since it was loaded"""
+
+	global _file_index
+
+	if _file_index is None:
+		return
+
+	def merge(file_index):
+		for pull_request_ID, entry in _file_index_changes.items():
+			set_file_index_entry(file_index, pull_request_ID, entry)
+
+		return file_index
+
+	_file_index = update_state('file-index', merge, {'pulls': {}, 'files': {}})
+	_file_index_changes.clear()
+
+def save_stats_cache():
+	"""Writes the diff stats cache back to disk, evicting the least recently
+	used entries above the 'stats-cache-size' limit"""
+
+	global _stats_cache
+
+	if _stats_cache is None:
+		return
+
+	cache_size = int(options['stats-cache-size'])
+
+	def merge(stats_cache):
+		# Keep the entries written by concurrent runs since the cache was loaded
+		for key, entry in _stats_cache.items():
+			if key not in stats_cache or stats_cache[key]['time'] < entry['time']:
+				stats_cache[key] = entry
+
+		if len(stats_cache) > cache_size:
+			keys = sorted(stats_cache.keys(), key=lambda key: stats_cache[key]['time'])
+
+			for key in keys[:len(keys) - cache_size]:
+				del stats_cache[key]
+
+		return stats_cache
+
+	_stats_cache = update_state('stats-cache', merge, {})
+
+def serve_request(connection, request, default_options):
+	"""Runs a command sent by a client of the gitpr server as if it had been run
+	by the client, in its directory and environment, and sends the output and
+	exit code back"""
+
+	global _fetched, _rate_limit_remaining, _record_stream, _server_relay, _terminal
+
+	os.environ.clear()
+	os.environ.update(request['env'])
+
+	options.clear()
+	options.update(default_options)
+
+	reset_repo_state()
+
+	_fetched = False
+	_rate_limit_remaining = None
+	_record_stream = None
+	_record_types.clear()
+	_terminal = {'isatty': request['isatty'], 'rows': request['rows']}
+
+	sys.argv = [sys.argv[0]] + request['args']
+
+	saved_stdout = sys.stdout
+	saved_stderr = sys.stderr
+
+	_server_relay = ServerRelay(connection)
 
-def get_default_repo_name():
-	repo_name = os.popen('git config github.repo').read().strip()
+	exit_code = 0
 
-	# get repo name from origin
-	if repo_name is None or repo_name == '':
-		repo_name = get_repo_name_for_remote('origin')
+	try:
+		os.chdir(request['cwd'])
+		main()
+	except UserWarning, e:
+		print color_text(e, 'error')
+		exit_code = 1
+	except SystemExit, e:
+		if isinstance(e.code, int):
+			exit_code = e.code
+		elif e.code is not None:
+			print e.code
+			exit_code = 1
+	except Exception:
+		traceback.print_exc()
+		exit_code = 1
 
-	if repo_name is None or repo_name == '':
-		raise UserWarning("Failed to determine github repository name")
+	sys.stdout = saved_stdout
+	sys.stderr = saved_stderr
 
-	return repo_name
+	_server_relay.close(exit_code)
+	_server_relay = None
 
-def get_git_base_path():
-	return os.popen('git rev-parse --show-toplevel').read().strip()
+	_record_stream = None
+	_terminal = None
 
-def get_original_dir_path():
-	git_base_path = get_git_base_path()
+	reset_repo_state()
 
-	f = open(os.path.join(get_work_dir(), '.git', 'original_dir_path'), 'rb')
-	original_dir_path = f.read()
-	f.close()
+def serve_requests(listener, socket_path, default_options):
+	"""Serves the commands sent to the gitpr server one at a time, until it is
+	stopped"""
 
-	if original_dir_path == None or original_dir_path == '':
-		config_path = os.readlink(os.path.join(git_base_path, '.git', 'config'))
-		original_dir_path = os.path.dirname(os.path.dirname(config_path))
+	started = time.time()
+	requests = 0
 
-	return original_dir_path
+	while True:
+		connection = listener.accept()[0]
 
-def get_work_dir():
-	global _work_dir
+		# Clients send their request once the server is ready for it, the ones
+		# that stopped waiting have run their command themselves
+		try:
+			connection.sendall(struct.pack('>cI', 'r', 0))
+			request = json.loads(connection.makefile('rb').readline())
+		except (socket.error, ValueError):
+			connection.close()
+			continue
 
-	if (_work_dir == None):
-		symbolic_ref = os.popen('git symbolic-ref HEAD').read().strip().replace('refs/heads/', '')
-		work_dir_global = options['work-dir']
+		control = request.get('control')
 
-		work_dir_option = None
+		if control is not None:
+			status = {'pid': os.getpid(), 'started': started, 'requests': requests}
 
-		if symbolic_ref:
-			work_dir_option = 'work-dir-%s' % symbolic_ref
+			try:
+				connection.sendall('%s\n' % json.dumps(status))
+			except socket.error:
+				pass
 
-		if work_dir_option:
-			_work_dir = os.popen('git config git-pull-request.%s' % work_dir_option).read().strip()
-			options[work_dir_option] = _work_dir
+			connection.close()
 
-		if not os.path.exists(_work_dir):
-			_work_dir = False
+			if control == 'stop':
+				break
 
-		if not _work_dir:
-			if work_dir_global and os.path.exists(work_dir_global):
-				_work_dir = work_dir_global
-			else:
-				_work_dir = False
+			continue
 
-	return _work_dir
+		serve_request(connection, request, default_options)
+		requests += 1
 
-def get_pull_request(repo_name, pull_request_ID):
-	"""Returns information retrieved from github about the pull request"""
+		connection.close()
 
-	url = "http://github.com/api/v2/json/pulls/%s/%s" % (repo_name, pull_request_ID)
-	data = github_json_request(url)
+	listener.close()
+	os.remove(socket_path)
 
-	return data['pull']
+def set_user_alias(alias, githubname):
+	"""Sets the alias in the user aliases and their reverse index"""
 
-def get_pull_requests(repo_name, filter_by_update_branch=False):
-	"""Returns information retrieved from github about the open pull requests on
-	the repository"""
+	previous_githubname = _users.get(alias)
 
-	url = "http://github.com/api/v2/json/pulls/%s/open" % repo_name
-	data = github_json_request(url)
-	pulls = data['pulls']
+	if previous_githubname is not None:
+		_users_by_login[previous_githubname].discard(alias)
 
-	if filter_by_update_branch:
-		update_branch = options['update-branch']
+		if not _users_by_login[previous_githubname]:
+			del _users_by_login[previous_githubname]
 
-		pull_requests = [pull for pull in pulls if pull['base']['ref'] == update_branch]
-	else:
-		pull_requests = pulls
+	_users[alias] = githubname
+	_users_by_login.setdefault(githubname, set()).add(alias)
 
-	return pull_requests
+def set_batch_progress(journal_key, pull_request_ID, progress = None):
+	"""Records the progress of a pull request in the journal of a batch command,
+	or forgets the whole journal if pull_request_ID is None"""
 
-def get_pull_request_ID(branch_name):
-	"""Returns the pull request number of the branch with the name"""
+	def update(batch_journal):
+		if pull_request_ID is None:
+			batch_journal.pop(journal_key, None)
+		else:
+			batch_journal.setdefault(journal_key, {})[str(pull_request_ID)] = progress
 
-	m = re.search("^pull-request-(\d+)", branch_name)
+		return batch_journal
 
-	return int(m.group(1))
+	update_state('batch-journal', update, {})
 
-def get_repo_name_for_remote(remote_name):
-	"""Returns the repository name for the remote with the name"""
+def set_file_index_entry(file_index, pull_request_ID, entry):
+	"""Replaces the files changed by the pull request in the file index and its
+	inverted index, or removes the pull request if entry is None"""
 
-	remotes = os.popen('git remote -v').read()
-	m = re.search("^%s[^\n]+?github\.com[^\n]*?[:/]([^\n]+?)\.git" % remote_name, remotes, re.MULTILINE)
+	pull_request_ID = int(pull_request_ID)
+	previous_entry = file_index['pulls'].pop(str(pull_request_ID), None)
 
-	if m is not None and m.group(1) != '':
-		return m.group(1)
+	if previous_entry is not None:
+		for path in previous_entry['files']:
+			pull_request_IDs = file_index['files'].get(path, [])
 
-def get_repo_url(pull_request):
-	"""Returns the git URL of the repository the pull request originated from"""
+			if pull_request_ID in pull_request_IDs:
+				pull_request_IDs.remove(pull_request_ID)
 
-	repo_url = pull_request['head']['repository']['url'].replace('https', 'git')
-	private_repo = pull_request['head']['repository']['private']
+			if not pull_request_IDs:
+				file_index['files'].pop(path, None)
 
-	if private_repo:
-		repo_url = repo_url.replace('git://github.com/', 'git@github.com:')
+	if entry is None:
+		return
 
-	return repo_url
+	file_index['pulls'][str(pull_request_ID)] = entry
 
-def github_json_request(url, params = None, authenticate = True):
-	if params is not None:
-		data = urllib.urlencode(params)
-		req = urllib2.Request(url, data)
-	else:
-		req = urllib2.Request(url)
+	for path in entry['files']:
+		file_index['files'].setdefault(path, []).append(pull_request_ID)
 
-	if authenticate:
-		authorize_request(req)
+def set_treeish(pull_request_ID, branch_treeish):
+	"""Records the original commits of a pull request branch before it was
+	updated, or forgets them if branch_treeish is None"""
 
-	print url
+	def update(treeish):
+		if branch_treeish is None:
+			treeish.pop(str(pull_request_ID), None)
+		else:
+			treeish[str(pull_request_ID)] = branch_treeish
 
-	try:
-		response = urllib2.urlopen(req)
-	except urllib2.URLError, msg:
-		raise UserWarning("Error communicating with github: \n%s\n%s" % (url, msg))
+		return treeish
 
-	data = response.read()
-	if data == '':
-		raise UserWarning("Invalid response from github")
+	update_state('treeish', update, {})
 
-	data = json.loads(data)
-	# print json.dumps(data,sort_keys=True, indent=4)
-	return data
+def set_update_progress(work_dir, update_progress):
+	"""Records the progress of an update being performed in the work directory,
+	or forgets it if update_progress is None"""
 
-def in_work_dir():
-	git_base_path = get_git_base_path()
+	if not work_dir:
+		return
 
-	work_dir = get_work_dir()
+	work_dir = os.path.realpath(work_dir)
 
-	return git_base_path == work_dir and os.path.islink(os.path.join(git_base_path, '.git', 'config'))
+	def update(updates):
+		if update_progress is None:
+			updates.pop(work_dir, None)
+		else:
+			updates[work_dir] = update_progress
 
-def load_options():
-	all_config = os.popen('git config -l').read().strip()
-	git_base_path = os.popen('git rev-parse --show-toplevel').read().strip()
+		return updates
 
-	path_prefix = "%s." % git_base_path
+	update_state('updates', update, {})
 
-	overrides = {}
+def start_server(socket_path, default_options):
+	"""Starts the gitpr server in the background, listening on the socket"""
 
-	matches = re.findall("^git-pull-request\.([^=]+)=([^\n]*)$", all_config, re.MULTILINE)
+	socket_dir = os.path.dirname(socket_path)
 
-	for k in matches:
-		key = k[0]
-		value = k[1]
+	if not os.path.isdir(socket_dir):
+		os.makedirs(socket_dir, 0700)
 
-		if value.lower() in ('f', 'false', 'no'):
-			value = False
-		elif value.lower() in ('t', 'true', 'yes'):
-			value = True
-		elif value.lower() in ('', 'none', 'null', 'nil'):
-			value = None
+	socket_dir_info = os.lstat(socket_dir)
 
-		if key.find(path_prefix) == -1:
-			options[key] = value
-		else:
-			key = key.replace(path_prefix, '')
-			overrides[key] = value
+	# The clients only connect to a server in a directory private to the user
+	if not stat.S_ISDIR(socket_dir_info.st_mode) or socket_dir_info.st_uid != os.getuid():
+		raise UserWarning("%s belongs to another user" % socket_dir)
 
-	options.update(overrides)
+	if socket_dir_info.st_mode & 077 != 0:
+		raise UserWarning("%s can be accessed by other users, run chmod 700 on it" % socket_dir)
 
-def load_users(filename):
-	try:
-		github_users_file = open(filename, 'r')
-	except IOError:
-		print "File %s could not be found. Using email names will not be available. Run the update-users command to enable this funcionality" % filename
-		return {}
+	# Left behind by a server that did not stop cleanly
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
 
-	github_users = json.load(github_users_file)
+	listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	listener.bind(socket_path)
+	listener.listen(16)
 
-	github_users_file.close()
+	sys.stdout.flush()
+	sys.stderr.flush()
 
-	return github_users
+	pid = os.fork()
 
-def main():
-	# parse command line options
-	try:
-		opts, args = getopt.gnu_getopt(sys.argv[1:], 'hqar:u:l:b:', ['help', 'quiet', 'all', 'repo=', 'reviewer=', 'update', 'no-update', 'user=', 'update-branch='])
-	except getopt.GetoptError, e:
-		raise UserWarning("%s\nFor help use --help" % e)
+	if pid > 0:
+		listener.close()
+		os.waitpid(pid, 0)
 
-	if len(args) > 0 and args[0] == 'help':
-		command_help()
-		sys.exit(0)
+		status = request_server(socket_path, 'status')
 
-	# load git options
-	load_options()
+		if status is None:
+			raise UserWarning("The gitpr server could not be started")
 
-	global auth_string, users
-	global _work_dir
+		print color_text("Started the gitpr server (pid %s)" % status['pid'], 'success')
+		return
 
-	_work_dir = None
+	# Detach from the terminal and the shell of the command
+	os.setsid()
 
-	repo_name = None
-	reviewer_repo_name = None
+	if os.fork() > 0:
+		os._exit(0)
 
-	username = os.popen('git config github.user').read().strip()
-	auth_token = os.popen('git config github.token').read().strip()
+	devnull = os.open(os.devnull, os.O_RDWR)
 
-	if len(username) == 0:
-		username = raw_input("Github username: ").strip()
-		os.system("git config --global github.user %s" % username)
+	for fd in (0, 1, 2):
+		os.dup2(devnull, fd)
 
-	if len(auth_token) == 0:
-		print "Please go to https://github.com/account/admin to find your API token"
-		auth_token = raw_input("Github API token: ").strip()
-		os.system("git config --global github.token %s" % auth_token)
+	os.close(devnull)
+	os.chdir('/')
 
-	auth_user = "%s/token" % username
-	auth_string = base64.encodestring('%s:%s' % (auth_user, auth_token)).replace('\n', '')
+	reset_repo_state()
 
-	fetch_auto_update = options['fetch-auto-update']
+	try:
+		serve_requests(listener, socket_path, default_options)
+	finally:
+		os._exit(0)
 
-	info_user = username
-	submitOpenGitHub = options['submit-open-github']
+def update_commit_graph(background = False):
+	"""Writes the commits missing from the commit-graph, with their changed-path
+	Bloom filters, as a new layer that git merges with the previous ones as
+	they grow. Layers written without Bloom filters (for example by
+	gc.writeCommitGraph) never get them, so then all the layers are replaced
+	by a single one instead."""
 
-	# manage github usernames
-	users_alias_file = os.popen('git config git-pull-request.users-alias-file').read().strip()
+	split = '--split'
 
-	if len(users_alias_file) == 0:
-		users_alias_file = "git-pull-request.users"
+	if not all([layer['bloom'] for layer in get_commit_graph_layers()]):
+		split = '--split=replace'
 
-	if len(args) > 0 and args[0] != "update-users":
-		users = load_users(users_alias_file)
+	args = ['git', 'commit-graph', 'write', '--reachable', '--changed-paths', split, '--no-progress']
 
+	if background:
+		devnull = open(os.devnull, 'wb')
+		subprocess.Popen(args, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+		devnull.close()
+		return
 
-	# process options
-	for o, a in opts:
-		if o in ('-h', '--help'):
-			command_help()
-			sys.exit(0)
-		elif o in ('-l', '--user'):
-			info_user = lookup_alias(a)
-		elif o in ('-q', '--quiet'):
-			submitOpenGitHub = False
-		elif o in ('-a', '--all'):
-			options['filter-by-update-branch'] = False
-		elif o in ('-r', '--repo'):
-			if re.search('/', a):
-				repo_name = a
-			else:
-				repo_name = get_repo_name_for_remote(a)
-		elif o in ('-b', '--update-branch'):
-			options['update-branch'] = a
-		elif o in ('-u', '--reviewer'):
-			reviewer_repo_name = a
-		elif o == '--update':
-			fetch_auto_update = True
-		elif o == '--no-update':
-			fetch_auto_update = False
+	ret = subprocess.call(args)
+	if ret != 0:
+		print color_text("Could not update the commit-graph", 'warning')
 
-	# get repo name from git config
-	if repo_name is None or repo_name == '':
-		repo_name = get_default_repo_name()
+def update_file_index(pull_request_ID, key, files):
+	"""Updates the files changed by the pull request in the file index, unless
+	they were indexed for the same merge-base and head commits. Passing no key
+	removes the pull request from the index."""
 
-	if reviewer_repo_name is None or reviewer_repo_name == '':
-		reviewer_repo_name = os.popen('git config github.reviewer').read().strip()
+	load_file_index()
 
-	if reviewer_repo_name:
-		reviewer_repo_name = lookup_alias(reviewer_repo_name)
+	entry = _file_index['pulls'].get(str(pull_request_ID))
 
-	# process arguments
-	if len(args) > 0:
-		if args[0] == 'alias':
-			if len(args) >= 2:
-				command_alias(args[1], args[2], users_alias_file)
-		elif args[0] == 'close':
-			if len(args) >= 2:
-				command_close(repo_name, args[1])
-			else:
-				command_close(repo_name)
-		elif args[0] in ('continue-update', 'cu'):
-			command_continue_update()
-		elif args[0] == 'fetch':
-			command_fetch(repo_name, args[1], fetch_auto_update)
-		elif args[0] == 'fetch-all':
-			command_fetch_all(repo_name)
-		elif args[0] == 'help':
-			command_help()
-		elif args[0] == 'info':
-			command_info(info_user)
-		elif args[0] == 'info-detailed':
-			command_info(info_user, True)
-		elif args[0] == 'merge':
-			if len(args) >= 2:
-				command_merge(repo_name, args[1])
-			else:
-				command_merge(repo_name)
-		elif args[0] == 'open':
-			if len(args) >= 2:
-				command_open(repo_name, args[1])
-			else:
-				command_open(repo_name)
-		elif args[0] == 'pull':
-			command_pull(repo_name)
-		elif args[0] == 'submit':
-			pull_body = None
-			pull_title = None
+	if entry is None and key is None:
+		return
 
-			if len(args) >= 2:
-				pull_body = args[1]
+	if entry is not None and entry['key'] == key:
+		return
 
-			if len(args) >= 3:
-				pull_title = args[2]
+	entry = None
 
-			command_submit(repo_name, username, reviewer_repo_name, pull_body, pull_title, submitOpenGitHub)
-		elif args[0] == 'update':
-			if len(args) >= 2:
-					command_update(repo_name, args[1])
-			else:
-				command_update(repo_name, update_branch_option)
-		elif args[0] == 'update-users':
-			command_update_users(users_alias_file)
-		elif args[0] == 'show-alias':
-			if len(args) >= 2:
-				command_show_alias(args[1])
-		elif args[0] == 'stats' or args[0] == 'stat':
-			pull_request_ID = None
+	if key is not None:
+		entry = {'key': key, 'files': files}
 
-			if len(args) >= 2:
-				pull_request_ID = args[1]
+	# Merged per pull request by save_file_index
+	_file_index_changes[str(pull_request_ID)] = entry
 
-			get_pr_stats(repo_name, pull_request_ID)
-		else:
-			command_fetch(repo_name, args[0], fetch_auto_update)
-	else:
-		command_show(repo_name)
+	set_file_index_entry(_file_index, pull_request_ID, entry)
 
-def lookup_alias(key):
-	user_alias = key
+def update_state(name, function, default = None):
+	"""Replaces the data in the state file with the name by the result of calling
+	the function with it. Holds a lock on the file meanwhile, so that updates
+	from concurrent commands are not lost."""
+
+	lock_file = lock_path(get_state_path(name))
 
 	try:
-		if users and (key in users) and users[key]:
-			user_alias = users[key]
-	except Exception, e:
-		pass
+		data = function(load_state(name, default))
 
-	return user_alias
+		save_state(name, data)
+	finally:
+		lock_file.close()
 
-def open_URL(url):
-	if (os.popen('command -v open').read().strip() != ''):
-		ret = os.system('open -g "%s" 2>/dev/null' % url)
+	return data
 
-		if ret != 0:
-			os.system('open "%s"' % url)
+def update_pulls_cache(repo_name, pulls):
+	"""Records the open pull request IDs of the repository, used for shell
+	completion"""
 
-	elif (os.popen('command -v cygstart').read().strip() != ''):
-		os.system('cygstart "%s"' % url)
+	def update(pulls_cache):
+		pulls_cache.setdefault('repos', {})[repo_name] = [pull['number'] for pull in pulls]
+		pulls_cache.setdefault('times', {})[repo_name] = time.time()
 
-def post_comment(repo_name, pull_request_ID, comment):
-	url = "http://github.com/api/v2/json/issues/comment/%s/%s" % (repo_name, pull_request_ID)
-	params = {'comment': comment}
-	github_json_request(url, params)
+		return pulls_cache
+
+	update_state('pulls-cache', update, {})
 
 def update_branch(branch_name):
 	if in_work_dir():
@@ -1115,9 +4015,11 @@ def update_branch(branch_name):
 		print color_text("Switching to work directory %s" % work_dir, 'status')
 		os.chdir(work_dir)
 
-		f = open(os.path.join(work_dir, '.git', 'original_dir_path'), 'wb')
-		f.write(original_dir_path)
-		f.close()
+		set_update_progress(work_dir, {
+			'branch_name': branch_name,
+			'original_dir_path': original_dir_path,
+			'started': time.time()
+		})
 
 		ret = os.system('git reset --hard && git clean -f')
 		if ret != 0:
@@ -1133,7 +4035,7 @@ def update_branch(branch_name):
 	update_branch_option = options['update-branch']
 
 	parent_commit = os.popen('git merge-base %s %s' % (update_branch_option, branch_name)).read().strip()
-	head_commit = os.popen('git rev-parse HEAD').read().strip()
+	head_commit = rev_parse('HEAD')
 
 	if parent_commit == head_commit:
 		branch_treeish = head_commit[0:10]
@@ -1141,9 +4043,7 @@ def update_branch(branch_name):
 		branch_treeish = '%s..%s' % (parent_commit[0:10], head_commit[0:10])
 
 	pull_request_ID = get_pull_request_ID(branch_name)
-	f = open('/tmp/git-pull-request-treeish-%s' % pull_request_ID, 'wb')
-	f.write(branch_treeish)
-	f.close()
+	set_treeish(pull_request_ID, branch_treeish)
 
 	print color_text("Original commits: %s" % branch_treeish, 'status')
 
@@ -1156,6 +4056,17 @@ def update_branch(branch_name):
 
 	complete_update(branch_name)
 
+def write_json_file(path, data):
+	"""Writes the data as JSON to the file at the path. The file is replaced
+	atomically, so concurrent readers never see a partial write."""
+
+	fd, temp_path = tempfile.mkstemp(prefix='%s.' % os.path.basename(path), dir=os.path.dirname(os.path.abspath(path)))
+
+	f = os.fdopen(fd, 'wb')
+	json.dump(data, f)
+	f.close()
+
+	os.rename(temp_path, path)
 
 def log(*args):
 	for arg in args:
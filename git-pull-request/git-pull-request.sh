@@ -3,12 +3,23 @@
 # Add an alias for this script to your bash profile as follows:
 # alias gitpr="source YOUR_DIRECTORY/git-pull-request/git-pull-request.sh"
 
-> /tmp/git-pull-request-chdir
+# Each invocation gets its own file to hand back the directory to change into,
+# so that several gitpr commands can run at the same time
+export GIT_PULL_REQUEST_CHDIR=`mktemp "${TMPDIR:-/tmp}/git-pull-request-chdir.XXXXXX"`
 
 PR=`dirname "$BASH_SOURCE"`
-"$PR/git-pull-request.py" "$@"
 
-DIR=`cat /tmp/git-pull-request-chdir`
+# While the gitpr server runs, it runs the commands instead of a new process
+if [ -S "${TMPDIR:-/tmp}/git-pull-request-$UID/server.sock" ]; then
+	"$PR/git-pull-request-client.py" "$@"
+else
+	"$PR/git-pull-request.py" "$@"
+fi
+
+DIR=`cat "$GIT_PULL_REQUEST_CHDIR"`
+
+rm -f "$GIT_PULL_REQUEST_CHDIR"
+unset GIT_PULL_REQUEST_CHDIR
 
 if [ -n "$DIR" ]; then
 	cd $DIR